@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Replay synthetic updates through the real dispatcher against a stand-in Bot API and a SQLite database.
+
+    python benchmark.py [-n 500] [--scenario craft_cb ...] [--pool-size 1] [--save results.json]
+                        [--baseline results.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+
+import config
+
+BOT_TOKEN = '123456:benchmark'
+CW_BOT_ID = 408101137
+
+
+class StandInBotAPI:
+    """Answers Bot API calls locally, just well enough for python-telegram-bot to parse the results."""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.methods = dict()
+        self._lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with api._lock:
+                    api.connections += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[-1]
+                params = json.loads(body) if body and 'json' in self.headers.get('Content-Type', '') else dict()
+                payload = json.dumps({'ok': True, 'result': api.result(method, params)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = 'http://127.0.0.1:{}/bot'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, name='stand-in-api', daemon=True).start()
+
+    def result(self, method: str, params: dict):
+        with self._lock:
+            self.requests += 1
+            self.methods[method] = self.methods.get(method, 0) + 1
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Crafts Bot', 'username': 'cwcraftsbot'}
+        if method in ('sendMessage', 'editMessageText'):
+            return {'message_id': params.get('message_id', 1), 'date': int(time.time()),
+                    'chat': {'id': params.get('chat_id', 1), 'type': 'private'}, 'text': params.get('text', '')}
+        return True
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SyntheticUpdates:
+    def __init__(self, graph, users: int = 50):
+        self.graph = graph
+        self.users = users
+        self.update_id = 0
+        self.craftable = sorted(graph.result_of)
+        self.words = sorted({w for i in graph.items.values() for w in i.name.split()})
+        self.chatter = ['hello there', 'anyone up for the battle?', 'lol', 'where is the guild leader']
+
+    def _user(self, n: int) -> dict:
+        return {'id': 1000 + n % self.users, 'is_bot': False, 'first_name': 'Player{}'.format(n % self.users)}
+
+    def _message(self, n: int, text: str, **extra) -> dict:
+        self.update_id += 1
+        user = self._user(n)
+        message = {'message_id': self.update_id, 'date': int(time.time()), 'from': user,
+                   'chat': {'id': user['id'], 'type': 'private'}, 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        message.update(extra)
+        return {'update_id': self.update_id, 'message': message}
+
+    def _forward(self, n: int, text: str) -> dict:
+        return self._message(n, text, forward_from={'id': CW_BOT_ID, 'is_bot': True, 'first_name': 'Chat Wars'},
+                             forward_date=int(time.time()))
+
+    def craft_cb(self, n: int) -> list:
+        return [self._message(n, '/craft_{}'.format(self.craftable[n % len(self.craftable)]))]
+
+    def item_search(self, n: int) -> list:
+        if n % 4 == 0:
+            return [self._message(n, self.chatter[n % len(self.chatter)])]
+        return [self._message(n, self.words[n % len(self.words)].lower())]
+
+    def craft_list(self, n: int) -> list:
+        self.update_id += 1
+        filters = ('all', 'basic', 'complex', 'armour', 'weapon', 'recipe', 'fragment', 'potion', 'herb')
+        user = self._user(n)
+        return [{'update_id': self.update_id,
+                 'callback_query': {'id': str(self.update_id), 'from': user, 'chat_instance': 'bench',
+                                    'data': 'list|{}|{}'.format(filters[n % len(filters)], 1 + n % 2),
+                                    'message': {'message_id': n, 'date': int(time.time()),
+                                                'chat': {'id': user['id'], 'type': 'private'},
+                                                'text': 'Which items would you like to view?'}}}]
+
+    def process_stock(self, n: int) -> list:
+        items = sorted(self.graph.items.values(), key=lambda i: i.id)
+        lines = ['/a_{} {} x {}'.format(i.id, i.name, 1 + (n + k) % 20) for k, i in enumerate(items[n % 7::7])]
+        return [self._forward(n, '📦Storage (1234/4000):\n' + '\n'.join(lines))]
+
+    def process_recipe(self, n: int) -> list:
+        # /submit is replayed first but not measured; the recipe is forgotten beforehand, so the forward stores it
+        result = self.craftable[n % len(self.craftable)]
+        self._forget_recipe(result)
+        parts = ['{} x {}'.format(self.graph.items[e.ingredient].name, e.qty) for e in self.graph.result_of[result]]
+        recipe = '📃{} (recipe):\n'.format(self.graph.items[result].name) + '\n'.join(parts)
+        return [self._message(n, '/submit'), self._forward(n, recipe)]
+
+    def _forget_recipe(self, result: str) -> None:
+        from pony import orm
+        from graph import RecipeGraph, current_graph, install_graph
+        from models import Recipe
+        with orm.db_session:
+            orm.delete(r for r in Recipe if r.result_item.id == result)
+        graph = current_graph()
+        install_graph(RecipeGraph(graph.items.values(), [e for e in graph.edges if e.result != result]))
+
+    def craft_inline(self, n: int) -> list:
+        self.update_id += 1
+        item = sorted(self.graph.items)[n % len(self.graph.items)]
+        return [{'update_id': self.update_id,
+                 'inline_query': {'id': str(self.update_id), 'from': self._user(n),
+                                  'query': '{}-{}'.format(item, 1 + n % 10), 'offset': ''}}]
+
+    def search_inline(self, n: int) -> list:
+        self.update_id += 1
+        return [{'update_id': self.update_id,
+                 'inline_query': {'id': str(self.update_id), 'from': self._user(n),
+                                  'query': self.words[n % len(self.words)].lower()[:1 + n % 4],
+                                  'offset': '' if n % 3 else '20'}}]
+
+
+SCENARIOS = ('craft_cb', 'item_search', 'craft_list', 'process_stock', 'process_recipe', 'craft_inline',
+             'search_inline')
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def run(scenarios, iterations: int) -> dict:
+    from telegram import Update
+    from telegram.ext import Dispatcher
+    from pony import orm
+
+    # measure the handlers, not Telegram's flood limits
+    config.OUTBOX_GLOBAL_RATE = config.OUTBOX_CHAT_RATE = config.OUTBOX_GROUP_RATE = 0
+
+    import bot as crafts_bot
+    from graph import load_graph
+    from outbox import outbox
+    from botclient import make_bot
+    from models import bind, sync_data, on_sql
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    bind()
+    orm.set_sql_debug(False)
+    sync_data()
+    graph = load_graph()
+
+    queries = [0]
+    on_sql(lambda sql, elapsed: queries.__setitem__(0, queries[0] + 1))
+    errors = ErrorCounter()
+    logging.getLogger('telegram').addHandler(errors)
+
+    api = StandInBotAPI()
+    tg_bot = make_bot(BOT_TOKEN, workers=0, base_url=api.base_url)
+    dp = Dispatcher(tg_bot, Queue(), workers=0)
+    crafts_bot.register_handlers(dp)
+    updates = SyntheticUpdates(graph)
+    outbox.start()
+
+    results = dict()
+    try:
+        for name in scenarios:
+            build = getattr(updates, name)
+            for n in range(min(20, iterations)):  # warm up connections and caches
+                for data in build(n):
+                    dp.process_update(Update.de_json(data, tg_bot))
+            outbox.drain()
+
+            latencies = list()
+            measured_queries = measured_requests = errors.count = 0
+            connections = api.connections
+            started = time.perf_counter()
+            for n in range(iterations):
+                *setup, measured = build(n)
+                for data in setup:
+                    dp.process_update(Update.de_json(data, tg_bot))
+                outbox.drain()
+                before, requests_before = queries[0], api.requests
+                update = Update.de_json(measured, tg_bot)
+                start = time.perf_counter()
+                dp.process_update(update)
+                latencies.append(time.perf_counter() - start)
+                outbox.drain()
+                measured_queries += queries[0] - before
+                measured_requests += api.requests - requests_before
+            elapsed = time.perf_counter() - started
+
+            results[name] = {'updates': iterations,
+                             'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+                             'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+                             'updates_per_sec': round(iterations / elapsed, 1),
+                             'queries_per_update': round(measured_queries / iterations, 2),
+                             'api_calls_per_update': round(measured_requests / iterations, 2),
+                             'connections_opened': api.connections - connections,
+                             'errors': errors.count}
+    finally:
+        outbox.stop()
+        api.close()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = list()
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ('p50_ms', 'p99_ms', 'queries_per_update'):
+            if current[metric] > base[metric] * (1 + tolerance) and current[metric] - base[metric] > 0.05:
+                regressions.append('{}: {} {} -> {}'.format(name, metric, base[metric], current[metric]))
+        if current['updates_per_sec'] < base['updates_per_sec'] * (1 - tolerance):
+            regressions.append('{}: updates_per_sec {} -> {}'.format(
+                name, base['updates_per_sec'], current['updates_per_sec']))
+    return regressions
+
+
+def print_table(results: dict) -> None:
+    columns = ('p50_ms', 'p99_ms', 'updates_per_sec', 'queries_per_update', 'api_calls_per_update',
+               'connections_opened', 'errors')
+    print('{:<16}'.format('scenario') + ''.join('{:>22}'.format(c) for c in columns))
+    for name, result in results.items():
+        print('{:<16}'.format(name) + ''.join('{:>22}'.format(result[c]) for c in columns))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the bot\'s hot handlers.')
+    parser.add_argument('-n', '--iterations', type=int, default=500)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='defaults to all of them')
+    parser.add_argument('--database', help='SQLite file to use, a temporary one by default')
+    parser.add_argument('--pool-size', type=int, help='Bot API connections to keep alive, sized from the workers by '
+                                                        'default')
+    parser.add_argument('--save', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    database = args.database or os.path.join(tempfile.mkdtemp(prefix='cwcrafts-bench-'), 'bench.sqlite')
+    config.DB_PARAMS = {'provider': 'sqlite', 'filename': os.path.abspath(database), 'create_db': True}
+    if args.pool_size:
+        config.BOT_API_POOL_SIZE = args.pool_size
+
+    results = run(args.scenario or SCENARIOS, args.iterations)
+    print_table(results)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
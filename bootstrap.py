@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("cw-crafts-bot")
+
+
+class StartupTimer:
+    """Collects how long each startup phase took and logs one report once all expected phases have finished."""
+
+    def __init__(self, expected=()):
+        self.started = time.perf_counter()
+        self.expected = set(expected)
+        self.phases = dict()  # name -> (start offset, duration), both in seconds
+        self._lock = threading.Lock()
+        self._reported = False
+
+    def record(self, name: str, start: float, end: float) -> None:
+        with self._lock:
+            self.phases[name] = (start - self.started, end - start)
+            ready = not self._reported and self.expected <= set(self.phases)
+            if ready:
+                self._reported = True
+        if ready:
+            logger.info(self.report())
+
+    def mark(self, name: str) -> None:
+        # a phase that started when the timer was created, eg. module imports
+        self.record(name, self.started, time.perf_counter())
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def report(self) -> str:
+        lines = ['startup timings:']
+        for name, (offset, duration) in sorted(self.phases.items(), key=lambda p: p[1][0]):
+            lines.append('  {:<10} {:>8.1f}ms  (at +{:.1f}ms)'.format(name, duration * 1000, offset * 1000))
+        return '\n'.join(lines)
+
+
+startup = StartupTimer(expected=('import', 'bind', 'mapping', 'webhook'))
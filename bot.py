@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
+from bootstrap import startup
+
 import re
-from uuid import uuid4
+import threading
+import time
+from html import escape
 from datetime import datetime
+from uuid import uuid4
 
 import config
 
@@ -9,13 +14,24 @@ from telegram import Update, Bot, Chat, Message, User, InlineKeyboardMarkup, Inl
     InputTextMessageContent
 from telegram.ext import Updater, Filters, RegexHandler, CommandHandler, TypeHandler, CallbackQueryHandler, \
     MessageHandler, ConversationHandler, InlineQueryHandler
-from telegram.ext.dispatcher import run_async
 
 from consts import item_filter_kb, stock_re, recipe_re, recipe_parts_re, tavern_hint_re
-from helpers import ForwardedFrom, build_craft_kb, gen_craft_tree
+from helpers import ForwardedFrom, build_craft_kb, build_list_kb, gen_craft_tree, gen_shopping_list, gen_tree_view
+from graph import Edge, current_graph, install_graph, load_graph, add_edges
+from snapshot import load_snapshot, dump_snapshot
+from cache import render_cache
+from categories import craft_command
+from outbox import outbox
+from botclient import make_bot, pool_stats
+from userstore import user_store
+from stockhistory import record_stock, recent_changes, trend, totals, top_holders
+from prefilter import query_filter
+from submissions import Submission, parse_submissions, import_submissions, describe, did_you_mean
+from shared import make_backend, on_volume, LocalBackend, SharedConversations, PersistentData
+from metrics import handler_metrics, serve_on_webhook, serve_standalone
 
 from pony import orm
-from models import User as dbUser, Recipe as dbRecipe, Item as dbItem
+from models import User as dbUser, Recipe as dbRecipe, Stock as dbStock, bind, time_binding, needs_db, on_sql
 
 import logging
 
@@ -23,6 +39,12 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
                     level=getattr(logging, config.LOGLEVEL))
 
 logger = logging.getLogger("cw-crafts-bot")
+process_id = uuid4().hex  # tags what this process publishes
+
+# set up by register_handlers, so importing the bot creates no state files
+backend = None
+user_data = None
+chat_data = None
 
 
 def start(bot: Bot, update: Update) -> None:
@@ -32,7 +54,7 @@ def start(bot: Bot, update: Update) -> None:
     msg = update.effective_message  # type: Message
     usr = update.effective_user  # type: User
 
-    msg.reply_text('Welcome to Chat Wars Crafts Bot.\nCheck out /help for more information!')
+    outbox.reply(msg, 'Welcome to Chat Wars Crafts Bot.\nCheck out /help for more information!')
 
     logger.debug("Exiting: start")
     return
@@ -45,15 +67,20 @@ def help(bot: Bot, update: Update) -> None:
     msg = update.effective_message  # type: Message
     usr = update.effective_user  # type: User
 
-    msg.reply_text("This bot was created to help you with your <a href='http://t.me/chtwrsbot'>Chat Wars</a> "
-                   "crafting needs.\n\n"
-                   "To get started, please forward your /more from @chtwrsbot to me.\nYou may also view all available "
-                   "craftable items with the /craft command.\nTo view the crafting recipe for a specific item you may "
-                   "use the /craft_code command, where <code>code</code> is the item code of the item to craft.\n\n"
-                   "To add a recipe to the database, you may use the /submit command.\n\n"
-                   "PM @jjw91 if you want to be added to /credits.",
-                   parse_mode='HTML',
-                   disable_web_page_preview=True)
+    outbox.reply(msg, "This bot was created to help you with your <a href='http://t.me/chtwrsbot'>Chat Wars</a> "
+                      "crafting needs.\n\n"
+                      "To get started, please forward your /more from @chtwrsbot to me.\nYou may also view all "
+                      "available craftable items with the /craft command.\nTo view the crafting recipe for a specific "
+                      "item you may use the /craft_code command, where <code>code</code> is the item code of the "
+                      "item to craft. Add a quantity, eg. <code>/craft_code x10</code>, or use /mats to see the total "
+                      "materials needed.\n\n"
+                      "To add a recipe to the database, you may use the /submit command, or /batch to add many "
+                      "at once.\n\n"
+                      "Every /more you forward is kept, see /history for how your stock changed or use /guildstock "
+                      "in your guild's chat for everyone's stock together.\n\n"
+                      "PM @jjw91 if you want to be added to /credits.",
+                      parse_mode='HTML',
+                      disable_web_page_preview=True)
 
     logger.debug("Exiting: help")
     return
@@ -68,7 +95,7 @@ def ping(bot: Bot, update: Update) -> None:
 
     diff = msg.date - datetime.utcnow()
 
-    msg.reply_text('Response time: {}ms'.format((diff.microseconds / 1000)))
+    outbox.reply(msg, 'Response time: {}ms'.format((diff.microseconds / 1000)))
 
     logger.debug("Exiting: ping")
     return
@@ -81,15 +108,34 @@ def credits(bot: Bot, update: Update) -> None:
     msg = update.effective_message  # type: Message
     usr = update.effective_user  # type: User
 
-    msg.reply_text("<i>Thanks to the following for helping add recipe info:</i>\n"
-                  "@JayBingHo, @tautologicall, @cwrecipe, @moonriot, @chwikiTaskforce and 🦈LIFE",
-                  parse_mode='HTML',
-                  disable_web_page_preview=True)
+    outbox.reply(msg, "<i>Thanks to the following for helping add recipe info:</i>\n"
+                     "@JayBingHo, @tautologicall, @cwrecipe, @moonriot, @chwikiTaskforce and 🦈LIFE",
+                     parse_mode='HTML',
+                     disable_web_page_preview=True)
 
     logger.debug("Exiting: credits")
     return
 
 
+def stats(bot: Bot, update: Update) -> None:
+    logger.debug("Entering: stats")
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    cache_stats = render_cache.stats()
+    user_stats = user_store.stats()
+    outbox.reply(msg, '<b>Render cache</b>\n' +
+                      ''.join('<code>{:<13} {}</code>\n'.format(k, v) for k, v in cache_stats.items()) +
+                      '\n<b>User writes</b>\n' +
+                      ''.join('<code>{:<13} {}</code>\n'.format(k, v) for k, v in user_stats.items()),
+                      parse_mode='HTML')
+
+    logger.debug("Exiting: stats")
+    return
+
+
 def version(bot: Bot, update: Update) -> None:
     logger.debug("Entering: version")
 
@@ -97,13 +143,12 @@ def version(bot: Bot, update: Update) -> None:
     msg = update.effective_message  # type: Message
     usr = update.effective_user  # type: User
 
-    msg.reply_text(version_string(), parse_mode='HTML')
+    outbox.reply(msg, version_string(), parse_mode='HTML')
 
     logger.debug("Exiting: version")
     return
 
 
-@run_async
 def dbhandler(bot: Bot, update: Update) -> None:
     logger.debug("Entering: dbhandler")
 
@@ -121,10 +166,10 @@ def dbhandler(bot: Bot, update: Update) -> None:
     if msg and msg.new_chat_members:
         update_users.extend(msg.new_chat_members)
 
-    with orm.db_session:
-        for u in update_users:
-            logger.debug("create or update data for User: {} ({})".format(u.full_name, u.id))
-            dbUser.update_or_create(u)
+    # written to the database in batches by user_store.flush
+    for u in update_users:
+        if u:
+            user_store.touch(u)
 
     logger.debug("Exiting: dbhandler")
     return
@@ -139,13 +184,12 @@ def craft(bot: Bot, update: Update) -> None:
 
     kb_markup = InlineKeyboardMarkup(item_filter_kb)
 
-    msg.reply_text('Which items would you like to view?', reply_markup=kb_markup)
+    outbox.reply(msg, 'Which items would you like to view?', reply_markup=kb_markup)
 
     logger.debug("Exiting: craft")
     return
 
 
-@orm.db_session
 def craft_list(bot: Bot, update: Update, groups: tuple) -> None:
     logger.debug("Entering: craft_list with args %s", groups)
 
@@ -153,50 +197,58 @@ def craft_list(bot: Bot, update: Update, groups: tuple) -> None:
     msg = update.effective_message  # type: Message
     usr = update.effective_user  # type: User
 
-    update.callback_query.answer(text='Filtering...')
-
-    kb_markup = InlineKeyboardMarkup(item_filter_kb)
+    outbox.answer(update.callback_query, text='Filtering...')
 
-    item_filter = groups[0]
-    craft_cmd = 'craft'
-
-    if item_filter == 'all':
-        items = dbItem.select(lambda i: i).order_by(lambda i: i.id)
-    elif item_filter == 'basic':
-        items = dbItem.select(lambda i: not i.complex).order_by(lambda i: i.id)
-    elif item_filter == 'complex':
-        items = dbItem.select(lambda i: i.complex).order_by(lambda i: i.id)
-    elif item_filter == 'armour':
-        items = dbItem.select(lambda i: i.id.startswith('a')).order_by(lambda i: i.id)
-    elif item_filter == 'weapon':
-        items = dbItem.select(lambda i: i.id.startswith('w')).order_by(lambda i: i.id)
-    elif item_filter == 'recipe':
-        items = dbItem.select(lambda i: i.id.startswith('r')).order_by(lambda i: i.id)
-    elif item_filter == 'fragment':
-        items = dbItem.select(lambda i: i.id.startswith('k')).order_by(lambda i: i.id)
-    elif item_filter == 'potion':
-        items = dbItem.select(lambda i: i.id.startswith('p')).order_by(lambda i: i.id)
-        craft_cmd = 'brew'
-    elif item_filter == 'herb':
-        # SQL> select * from item WHERE id ~ E'^\\d+$' and id::integer between 39 and 69;
-        items = dbItem.select(lambda i:  orm.raw_sql(r"i.id ~ E'^\\d+$$'") and orm.between(orm.raw_sql("i.id::integer"), 39, 69)).order_by(lambda i: i.id)
-        craft_cmd = 'brew'
-    else:
-        items = list()
+    item_filter, page = groups
+    catalogue = current_graph().categories
 
-    items_list = '<b>{} items</b>\n'.format(item_filter.title())
+    pages = catalogue.page_count(item_filter)
+    page = min(max(int(page), 1), pages) if page else 1
 
-    for item in items:
-        items_list += '<code>{:>3}</code> - {}'.format(item.id, item.name)
-        items_list += ' (/{}_{})\n'.format(craft_cmd, item.id) if item.complex else '\n'
+    items_list = catalogue.page(item_filter, page)
+    kb_markup = build_list_kb(item_filter, page, pages)
 
-    msg.edit_text(items_list, reply_markup=kb_markup, parse_mode='HTML')
+    outbox.edit(msg, items_list, reply_markup=kb_markup, parse_mode='HTML')
 
     logger.debug("Exiting: craft_list")
     return
 
 
-@orm.db_session
+def broken_recipe_text(item) -> str:
+    return "The recipe for <b>{}</b> needs itself somewhere down the tree, so I cannot show it.".format(item.name)
+
+
+def render_item(graph, item, count: int, path: tuple = None) -> tuple:
+    # the craft_cb reply text and keyboard, trees longer than config.MAX_TREE_LINES start out collapsed
+    kb_markup = None
+    collapsed = path is not None or graph.shape.size.get(item.id, 0) > config.MAX_TREE_LINES
+
+    if item.complex:
+        recipe_text = '<b>{name}</b>{count}\n\n'.format(name=item.name, count=f' x {count}' if count > 1 else '')
+        if collapsed:
+            tree_text, keyboard = gen_tree_view(graph, item.id, path or (), count)
+            recipe_text += tree_text
+            kb_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+        else:
+            recipe_text += gen_craft_tree(graph, item.id, count)
+            kb_markup = build_craft_kb(graph, item.id) if item.id in graph.result_of else None
+        if item.id in graph.result_of:
+            recipe_text += '\n<b>Total materials:</b>\n'
+            recipe_text += gen_shopping_list(graph, item.id, count)
+    else:
+        recipe_text = "<b>{}</b> cannot be crafted.".format(item.name)
+
+    if item.id in graph.ingredient_in:
+        recipe_text += '\n\n<b>Used in:</b>'
+        for t in graph.ingredient_in[item.id]:
+            result_item = graph.items[t.result]
+            recipe_text += '<code>\n\t{}</code>'.format(result_item.name)
+            if result_item.complex:
+                recipe_text += ' (/{}_{})'.format(craft_command(result_item), result_item.id)
+
+    return recipe_text, kb_markup
+
+
 def craft_cb(bot: Bot, update: Update, groups: tuple) -> None:
     logger.debug("Entering: craft_cb with args %s", groups)
 
@@ -204,53 +256,108 @@ def craft_cb(bot: Bot, update: Update, groups: tuple) -> None:
     msg = update.effective_message  # type: Message
     usr = update.effective_user  # type: User
 
-    if groups[0]:
-        itemid = groups[0]
-    else:
+    kind, itemid, count = groups
+    count = max(int(count), 1) if count else 1
+
+    if not itemid:
         help(bot, update)
         logger.debug("Exiting: craft_cb")
         return
 
     if itemid == "code":
-        msg.reply_text("Replace code with an actual item code you silly goose! eg. /craft_24")
+        outbox.reply(msg, "Replace code with an actual item code you silly goose! eg. /craft_24")
         logger.debug("Exiting: craft_cb")
         return
 
     logger.debug('craft_cb: fetching recipe for item with id: {}'.format(itemid))
 
-    try:
-        item = dbItem[itemid]
-    except orm.core.ObjectNotFound:
-        msg.reply_text("I'm sorry, but that item is not in the database.")
+    reply = render_cache.get(itemid, (kind, count))
+    if reply is not None:
+        outbox.reply(msg, reply[0], reply_markup=reply[1], parse_mode='HTML')
         logger.debug("Exiting: craft_cb")
         return
 
-    kb_markup = None
+    graph = current_graph()
+    item = graph.get(itemid)
+    if item is None:
+        outbox.reply(msg, "I'm sorry, but that item is not in the database.")
+        logger.debug("Exiting: craft_cb")
+        return
 
-    if item.complex:
-        recipe_text = '<b>{name}</b>\n\n'.format(name=item.name)
-        recipe_text += gen_craft_tree(item)
-    else:
-        recipe_text = "<b>{}</b> cannot be crafted.".format(item.name)
+    if item.id not in graph.shape.depth:
+        outbox.reply(msg, broken_recipe_text(item), parse_mode='HTML')
+        logger.debug("Exiting: craft_cb")
+        return
 
-    if item.ingredient_in:
-        recipe_text += '\n\n<b>Used in:</b>'
-        for t in item.ingredient_in.order_by(lambda t: t.result_item.id):
-            recipe_text += '<code>\n\t{}</code>'.format(t.result_item.name)
-            if t.result_item.complex:
-                command = 'craft'
-                if t.result_item.id.isdigit() and 39 <= int(t.result_item.id) <= 69:
-                    command = 'brew'
-                elif t.result_item.id.startswith('p'):
-                    command = 'brew'
-                recipe_text += ' (/{}_{})'.format(command, t.result_item.id)
-
-    msg.reply_text(recipe_text, reply_markup=kb_markup, parse_mode='HTML')
+    reply = render_item(graph, item, count)
+    render_cache.put(itemid, (kind, count), reply, graph)
+    outbox.reply(msg, reply[0], reply_markup=reply[1], parse_mode='HTML')
 
     logger.debug("Exiting: craft_cb")
     return
 
 
+def tree_cb(bot: Bot, update: Update, groups: tuple) -> None:
+    logger.debug("Entering: tree_cb with args %s", groups)
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    itemid, path, count = groups
+    path = tuple(path.split('.')) if path else ()
+    count = max(int(count), 1)
+
+    outbox.answer(update.callback_query)
+
+    reply = render_cache.get(itemid, ('tree', count, path))
+    if reply is None:
+        graph = current_graph()
+        item = graph.get(itemid)
+        if item is None or item.id not in graph.shape.depth:
+            logger.debug("Exiting: tree_cb")
+            return
+        reply = render_item(graph, item, count, path)
+        render_cache.put(itemid, ('tree', count, path), reply, graph)
+
+    outbox.edit(msg, reply[0], reply_markup=reply[1], parse_mode='HTML')
+
+    logger.debug("Exiting: tree_cb")
+    return
+
+
+def bill_of_materials(bot: Bot, update: Update, args: list) -> None:
+    logger.debug("Entering: bill_of_materials with args %s", args)
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    if not args or len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+        outbox.reply(msg, "Usage: /mats code [quantity], eg. /mats a25 10")
+        logger.debug("Exiting: bill_of_materials")
+        return
+
+    graph = current_graph()
+    item = graph.get(args[0])
+    count = max(int(args[1]), 1) if len(args) == 2 else 1
+
+    if item is None:
+        outbox.reply(msg, "I'm sorry, but that item is not in the database.")
+    elif item.id not in graph.result_of:
+        outbox.reply(msg, "<b>{}</b> cannot be crafted.".format(item.name), parse_mode='HTML')
+    elif item.id not in graph.shape.depth:
+        outbox.reply(msg, broken_recipe_text(item), parse_mode='HTML')
+    else:
+        outbox.reply(msg, '<b>Materials for {} x {}</b>\n\n'.format(count, item.name) +
+                          gen_shopping_list(graph, item.id, count),
+                          parse_mode='HTML')
+
+    logger.debug("Exiting: bill_of_materials")
+    return
+
+
+@needs_db
 @orm.db_session
 def process_stock(bot: Bot, update: Update) -> None:
     logger.debug("Entering: process_stock")
@@ -261,19 +368,222 @@ def process_stock(bot: Bot, update: Update) -> None:
 
     matches = re.findall(stock_re, msg.text)
 
-    if matches:
+    if matches and not len(current_graph()):
+        # every item would be skipped as unknown and the saved stock wiped
+        outbox.reply(msg, "I'm still loading the item list, please forward your stock again in a minute.")
+    elif matches:
+        graph = current_graph()
+        stock = dict()
         for stock_item in matches:
             itemid, name, qty = stock_item
-            logger.debug(f'updating item: {itemid} - {name} x {qty}')
-            item = dbItem[itemid]
-        msg.reply_text("Stock updated!")
+            if itemid in graph:
+                logger.debug(f'updating item: {itemid} - {name} x {qty}')
+                stock[itemid] = int(qty)
+            else:
+                logger.debug(f'skipping unknown item: {itemid} - {name} x {qty}')
+
+        user = dbUser.update_or_create(usr)
+        now = datetime.utcnow()
+        record_stock(user, stock, user.stock.items if user.stock else dict(), now)
+        if user.stock:
+            user.stock.set(items=stock, updated=now)
+        else:
+            dbStock(user=user, items=stock, updated=now)
+
+        reply_text = "Stock updated!"
+        craftable = graph.craftable(stock)
+        if craftable:
+            reply_text += '\n\n<b>You can craft:</b>'
+            for itemid, times in craftable.items():
+                item = graph.items[itemid]
+                reply_text += '\n<code>{:>3}</code> x {} (/{}_{})'.format(times, item.name, craft_command(item), itemid)
+            reply_text += '\n\nUse /need code to see what you are missing for anything else.'
+        outbox.reply(msg, reply_text, parse_mode='HTML')
     else:
-        msg.reply_text("Send the /more command to @chtwrsbot and forward the stock result here.")
+        outbox.reply(msg, "Send the /more command to @chtwrsbot and forward the stock result here.")
 
     logger.debug("Exiting: process_stock")
     return
 
 
+@needs_db
+def missing_items(bot: Bot, update: Update, args: list) -> None:
+    logger.debug("Entering: missing_items with args %s", args)
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    if not args or len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+        outbox.reply(msg, "Usage: /need code [quantity], eg. /need a25 2")
+        logger.debug("Exiting: missing_items")
+        return
+
+    graph = current_graph()
+    item = graph.get(args[0])
+    count = max(int(args[1]), 1) if len(args) == 2 else 1
+
+    if item is None:
+        outbox.reply(msg, "I'm sorry, but that item is not in the database.")
+        logger.debug("Exiting: missing_items")
+        return
+    if item.id not in graph.result_of:
+        outbox.reply(msg, "<b>{}</b> cannot be crafted.".format(item.name), parse_mode='HTML')
+        logger.debug("Exiting: missing_items")
+        return
+    if item.id not in graph.shape.depth:
+        outbox.reply(msg, broken_recipe_text(item), parse_mode='HTML')
+        logger.debug("Exiting: missing_items")
+        return
+
+    with orm.db_session:
+        stock = dbStock.get(user=usr.id)
+        stock = stock.items if stock else None
+
+    if stock is None:
+        outbox.reply(msg, "I don't know your stock yet. Send the /more command to @chtwrsbot and forward the stock "
+                          "result here.")
+        logger.debug("Exiting: missing_items")
+        return
+
+    deficit = graph.missing(item.id, stock, count)
+    if deficit:
+        reply_text = '<b>Missing for {} x {}</b>\n'.format(count, item.name)
+        for itemid, qty in deficit:
+            reply_text += '\n<code>{:>4} x {}</code>'.format(qty, graph.items[itemid].name)
+    else:
+        reply_text = 'You have everything you need to craft {} x <b>{}</b>!'.format(count, item.name)
+    outbox.reply(msg, reply_text, parse_mode='HTML')
+
+    logger.debug("Exiting: missing_items")
+    return
+
+
+def stock_line(graph, item_id: str, qty: int, sign: bool = False) -> str:
+    item = graph.get(item_id)
+    return '<code>{:>{}5} x {}</code>'.format(qty, '+' if sign else '', item.name if item else item_id)
+
+
+def trend_lines(points: list) -> str:
+    return ''.join('\n<code>{:%Y-%m-%d %H:%M} {:>6}</code>'.format(when, qty) for when, qty in points)
+
+
+@needs_db
+def stock_history(bot: Bot, update: Update, args: list) -> None:
+    logger.debug("Entering: stock_history with args %s", args)
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    graph = current_graph()
+    if args:
+        item = graph.get(args[0])
+        if item is None:
+            outbox.reply(msg, "I'm sorry, but that item is not in the database.")
+            logger.debug("Exiting: stock_history")
+            return
+        points = trend([usr.id], item.id)[-config.STOCK_TREND_POINTS:]
+        reply_text = '<b>Your {}</b>'.format(item.name) + (trend_lines(points) or '\nNot in any stock you sent me.')
+    else:
+        changes = recent_changes(usr.id, 5)
+        if not changes:
+            outbox.reply(msg, "Forward your /more from @chtwrsbot here to start your stock history.")
+            logger.debug("Exiting: stock_history")
+            return
+        reply_text = '<b>Your last stock changes</b>'
+        for when, items in changes:
+            reply_text += '\n\n<b>{:%Y-%m-%d %H:%M}</b>'.format(when)
+            for item_id, qty in sorted(items.items()):
+                reply_text += '\n' + stock_line(graph, item_id, qty, sign=True)
+        reply_text += '\n\nUse /history code to see how one item changed.'
+    outbox.reply(msg, reply_text, parse_mode='HTML')
+
+    logger.debug("Exiting: stock_history")
+    return
+
+
+@needs_db
+def guild_stock(bot: Bot, update: Update, args: list, chat_data: dict) -> None:
+    logger.debug("Entering: guild_stock with args %s", args)
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    if chat.type == chat.PRIVATE:
+        outbox.reply(msg, "Use /guildstock in your guild's chat, everyone who uses it there is counted in.")
+        logger.debug("Exiting: guild_stock")
+        return
+
+    members = chat_data.setdefault('stock_users', list())
+    if usr.id not in members:
+        members.append(usr.id)
+
+    graph = current_graph()
+    if args:
+        item = graph.get(args[0])
+        if item is None:
+            outbox.reply(msg, "I'm sorry, but that item is not in the database.")
+            logger.debug("Exiting: guild_stock")
+            return
+        reply_text = '<b>{} in this chat</b> ({} members)'.format(item.name, len(members))
+        for name, qty in top_holders(members, item.id, 5):
+            reply_text += '\n<code>{:>5}</code> {}'.format(qty, escape(name))
+        reply_text += '\n' + trend_lines(trend(members, item.id)[-config.STOCK_TREND_POINTS:])
+    else:
+        held = sorted(totals(members).items(), key=lambda i: (-i[1], i[0]))
+        reply_text = '<b>Stock in this chat</b> ({} members)'.format(len(members))
+        for item_id, qty in held[:20]:
+            reply_text += '\n' + stock_line(graph, item_id, qty)
+        reply_text += '\n\nUse /guildstock code for one item.'
+    outbox.reply(msg, reply_text, parse_mode='HTML')
+
+    logger.debug("Exiting: guild_stock")
+    return
+
+
+def apply_edges(edges: list) -> None:
+    graph = add_edges(edges)
+    changed = {e.result for e in edges} | {e.ingredient for e in edges}
+    render_cache.invalidate(graph.dependents(changed))
+
+
+def recipes_added(parts: list) -> None:
+    edges_added([Edge(p.id, p.result_item.id, p.ingredient_item.id, p.quantity_req) for p in parts])
+
+
+def edges_added(edges: list) -> None:
+    apply_edges(edges)
+    backend.publish('recipes', {'origin': process_id, 'edges': edges})
+
+
+def recipes_published(message: dict) -> None:
+    # recipes submitted through another process, several of them can share a WORKER_ID
+    if message['origin'] != process_id:
+        apply_edges([Edge(*e) for e in message['edges']])
+
+
+def refresh_graph() -> None:
+    # retried until the database answers, the bot would keep serving an empty or stale graph otherwise
+    delay = 1
+    while True:
+        try:
+            bind()
+            graph = load_graph()
+            break
+        except Exception:
+            logger.exception("failed to refresh the recipe graph from the database, retrying in %ds", delay)
+            time.sleep(delay)
+            delay = min(delay * 2, config.GRAPH_RETRY_MAX_DELAY)
+    render_cache.clear()
+    if config.WORKER_ID == 0:
+        try:
+            dump_snapshot(graph, config.SNAPSHOT_PATH)
+        except Exception:
+            logger.exception("failed to write the recipe snapshot")
+
+
 def submit_recipe(bot: Bot, update: Update) -> int:
     logger.debug("Entering: submit_recipe")
 
@@ -281,7 +591,7 @@ def submit_recipe(bot: Bot, update: Update) -> int:
     msg = update.effective_message  # type: Message
     usr = update.effective_user  # type: User
 
-    msg.reply_text("Please forward me the recipe from @chtwrsbot that you would like to submit.")
+    outbox.reply(msg, "Please forward me the recipe from @chtwrsbot that you would like to submit.")
 
     logger.debug("Exiting: submit_recipe")
     return 0
@@ -294,12 +604,13 @@ def cancel_recipe(bot: Bot, update: Update) -> int:
     msg = update.effective_message  # type: Message
     usr = update.effective_user  # type: User
 
-    msg.reply_text("Recipe submission cancelled. Thank you for trying ^.^")
+    outbox.reply(msg, "Recipe submission cancelled. Thank you for trying ^.^")
 
     logger.debug("Exiting: cancel_recipe")
     return ConversationHandler.END
 
 
+@needs_db
 def process_recipe(bot: Bot, update: Update) -> int:
     logger.debug("Entering: process_recipe")
 
@@ -307,55 +618,168 @@ def process_recipe(bot: Bot, update: Update) -> int:
     msg = update.effective_message  # type: Message
     usr = update.effective_user  # type: User
 
+    names = current_graph().names
+
     if re.match(recipe_re, msg.text):
         match = re.match(recipe_re, msg.text)
         matches = re.findall(recipe_parts_re, msg.text)
         if matches:
             logger.debug("process_recipe: processing recipe parts")
-            with orm.db_session:
-                r = dbItem.select(lambda i: i.name == match.group('name')).first()
-                if r:
-                    logger.debug("process_recipe: item %s found in db, continuing processing", r.name)
-                    for part in matches:
-                        name, qty = part
-                        i = dbItem.select(lambda i: i.name.lower() == name.lower()).first()
-                        if i:
-                            logger.debug("process_recipe: adding %s x %s to item recipe", qty, name)
-                            dbRecipe(result_item=r.id, ingredient_item=i.id, quantity_req=qty)
-                        else:
-                            logger.debug("could not find item in database with name %s, cancelling", name)
-                            dbItem.rollback()
-                            msg.reply_text(f"Unable to find <b>{name}</b> in my database, cancelling submission", parse_mode='HTML')
-                            return ConversationHandler.END
-                    msg.reply_text("Thanks for submitting the recipe for <b>{}</b>!".format(r.name), parse_mode='HTML')
-                else:
-                    logger.debug("process_recipe: item not found")
-                    msg.reply_text("That item is not in my database. Cancelling recipe submission.")
+            r = names.resolve(match.group('name'))
+            if r and not r.complex:
+                outbox.reply(msg, "<b>{}</b> is not crafted, so it cannot have a recipe. Cancelling recipe "
+                                  "submission.".format(r.name), parse_mode='HTML')
+            elif r:
+                logger.debug("process_recipe: item %s found in db, continuing processing", r.name)
+                ingredients = list()
+                for part in matches:
+                    name, qty = part
+                    i = names.resolve(name)
+                    if i:
+                        logger.debug("process_recipe: adding %s x %s (%s) to item recipe", qty, name, i.name)
+                        ingredients.append((i, qty))
+                    else:
+                        logger.debug("could not find item in database with name %s, cancelling", name)
+                        outbox.reply(msg, f"Unable to find <b>{name}</b> in my database, cancelling submission."
+                                          + did_you_mean(names.did_you_mean(name)), parse_mode='HTML')
+                        return ConversationHandler.END
+                known = {e.ingredient for e in current_graph().result_of.get(r.id, ())}
+                ingredients = [(i, qty) for i, qty in ingredients if i.id not in known]
+                if not ingredients:
+                    outbox.reply(msg, "I already know this recipe. Cancelling recipe submission.")
+                    return ConversationHandler.END
+                if current_graph().cycle_with((r.id, i.id) for i, qty in ingredients):
+                    outbox.reply(msg, "That would make <b>{}</b> part of its own recipe. Cancelling recipe "
+                                      "submission.".format(r.name), parse_mode='HTML')
+                    return ConversationHandler.END
+                with orm.db_session:
+                    parts = [dbRecipe(result_item=r.id, ingredient_item=i.id, quantity_req=qty) for i, qty in ingredients]
+                    orm.commit()
+                    recipes_added(parts)
+                outbox.reply(msg, "Thanks for submitting the recipe for <b>{}</b>!".format(r.name), parse_mode='HTML')
+            else:
+                logger.debug("process_recipe: item not found")
+                outbox.reply(msg, "<b>{}</b> is not in my database. Cancelling recipe submission.".format(
+                    match.group('name')) + did_you_mean(names.did_you_mean(match.group('name'))), parse_mode='HTML')
         return ConversationHandler.END
     elif re.search(tavern_hint_re, msg.text):
         match = re.search(tavern_hint_re, msg.text)
-        with orm.db_session:
-            r = dbItem.select(lambda i: i.name == match.group('name')).first()
-            if r:
-                i = dbItem.select(lambda i: i.name == match.group('item')).first()
-                if i:
-                    if dbRecipe.get(result_item=r.id, ingredient_item=i.id):
-                        msg.reply_text("I already know about this part of the recipe. Cancelling recipe submission.")
-                        return ConversationHandler.END
-                    dbRecipe(result_item=r.id, ingredient_item=i.id, quantity_req=match.group('qty'))
-                    msg.reply_text("Thanks for submitting a part for the recipe of <b>{}</b>!".format(r.name),
-                                   parse_mode='HTML')
-                else:
-                    msg.reply_text("{} is not in my database. Cancelling recipe submission.".format(match.group('item')))
+        r = names.resolve(match.group('name'))
+        if r and not r.complex:
+            outbox.reply(msg, "<b>{}</b> is not crafted, so it cannot have a recipe. Cancelling recipe "
+                              "submission.".format(r.name), parse_mode='HTML')
+        elif r:
+            i = names.resolve(match.group('item'))
+            if i:
+                if any(e.ingredient == i.id for e in current_graph().result_of.get(r.id, ())):
+                    outbox.reply(msg, "I already know about this part of the recipe. Cancelling recipe submission.")
+                    return ConversationHandler.END
+                if current_graph().cycle_with([(r.id, i.id)]):
+                    outbox.reply(msg, "That would make <b>{}</b> part of its own recipe. Cancelling recipe "
+                                      "submission.".format(r.name), parse_mode='HTML')
+                    return ConversationHandler.END
+                with orm.db_session:
+                    part = dbRecipe(result_item=r.id, ingredient_item=i.id, quantity_req=match.group('qty'))
+                    orm.commit()
+                    recipes_added([part])
+                outbox.reply(msg, "Thanks for submitting a part for the recipe of <b>{}</b>!".format(r.name),
+                                  parse_mode='HTML')
             else:
-                msg.reply_text("{} is not in my database. Cancelling recipe submission.".format(match.group('name')))
+                outbox.reply(msg, "<b>{}</b> is not in my database. Cancelling recipe submission.".format(
+                    match.group('item')) + did_you_mean(names.did_you_mean(match.group('item'))), parse_mode='HTML')
+        else:
+            outbox.reply(msg, "<b>{}</b> is not in my database. Cancelling recipe submission.".format(
+                match.group('name')) + did_you_mean(names.did_you_mean(match.group('name'))), parse_mode='HTML')
         return ConversationHandler.END
-    msg.reply_text("That is not a valid recipe or I fucked up my regex. Please forward it again or /cancel to cancel.")
+    outbox.reply(msg, "That is not a valid recipe or I fucked up my regex. Please forward it again or /cancel to "
+                      "cancel.")
 
     logger.debug("Exiting: process_recipe")
     return 0
 
 
+def batch_start(bot: Bot, update: Update, user_data: dict) -> int:
+    logger.debug("Entering: batch_start")
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    user_data['batch'] = list()
+    outbox.reply(msg, "Forward me as many recipes from @chtwrsbot as you like, or paste several into one message. "
+                      "Send /done when you are finished and I will add them all at once, or /cancel to stop.")
+
+    logger.debug("Exiting: batch_start")
+    return 0
+
+
+def batch_collect(bot: Bot, update: Update, user_data: dict) -> int:
+    logger.debug("Entering: batch_collect")
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    submissions = parse_submissions(msg.text)
+    if submissions:
+        user_data.setdefault('batch', list()).extend(submissions)
+    else:
+        outbox.reply(msg, "I could not find a recipe in that message. Send /done to add the ones so far.")
+
+    logger.debug("Exiting: batch_collect")
+    return 0
+
+
+@needs_db
+def batch_done(bot: Bot, update: Update, user_data: dict) -> int:
+    logger.debug("Entering: batch_done")
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    submissions = [Submission(name, [tuple(p) for p in parts]) for name, parts in user_data.get('batch', ())]
+    if not submissions:
+        user_data.pop('batch', None)
+        outbox.reply(msg, "You did not send me any recipes.")
+        logger.debug("Exiting: batch_done")
+        return ConversationHandler.END
+
+    outcomes, edges = import_submissions(submissions)
+    if edges:
+        edges_added(edges)
+    if any(o.status == 'failed' for o in outcomes):
+        # keep the batch so /done can be sent again
+        outbox.reply(msg, '\n'.join(describe(o) for o in outcomes if o.status == 'failed') +
+                     '\n\nSend /done to try again or /cancel to drop the batch.', parse_mode='HTML')
+        logger.debug("Exiting: batch_done")
+        return 0
+    user_data.pop('batch', None)
+
+    added = sum(1 for o in outcomes if o.status == 'added')
+    reply_text = '<b>Added {} of {} recipes</b>\n'.format(added, len(outcomes))
+    for outcome in outcomes:
+        reply_text += '\n' + describe(outcome)
+    outbox.reply(msg, reply_text, parse_mode='HTML')
+
+    logger.debug("Exiting: batch_done")
+    return ConversationHandler.END
+
+
+def batch_cancel(bot: Bot, update: Update, user_data: dict) -> int:
+    logger.debug("Entering: batch_cancel")
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    user_data.pop('batch', None)
+    outbox.reply(msg, "Batch submission cancelled, nothing was added.")
+
+    logger.debug("Exiting: batch_cancel")
+    return ConversationHandler.END
+
+
 def item_search(bot: Bot, update: Update, args: list=None) -> None:
     logger.debug("Entering: item_search with args %s", args)
 
@@ -372,24 +796,27 @@ def item_search(bot: Bot, update: Update, args: list=None) -> None:
 
     result_text = str()
 
-    with orm.db_session:
-        items = dbItem.select(lambda i: i).order_by(lambda i: i.id)
-        for keyword in keywords:
-            items = items.filter(lambda i: keyword.lower() in i.name.lower())
+    items = current_graph().names.search(keywords)
 
-        if len(items) > 1:
-            result_text = f'Search results for <b>{search_text}</b>\n'
+    if len(items) > 1:
+        result_text = f'Search results for <b>{search_text}</b>\n'
 
-            for item in items:
+        for item in items:
+            result_text += '<code>{:>3}</code> - {}'.format(item.id, item.name)
+            result_text += ' (/craft_{})\n'.format(item.id) if item.complex else ' (/i_{})\n'.format(item.id)
+    elif len(items) == 1:
+        item = items[0]
+        return craft_cb(bot, update, ('craft' if item.complex else 'i', item.id, None))
+    else:
+        result_text = f'No items matched your search for <b>{search_text}</b>'
+        suggestions = current_graph().names.fuzzy(search_text)
+        if suggestions:
+            result_text += '\n\nDid you mean:\n'
+            for item, score in suggestions:
                 result_text += '<code>{:>3}</code> - {}'.format(item.id, item.name)
                 result_text += ' (/craft_{})\n'.format(item.id) if item.complex else ' (/i_{})\n'.format(item.id)
-        elif len(items) == 1:
-            for item in items:
-                return craft_cb(bot, update, (item.id, ))
-        else:
-            result_text = f'No items matched your search for <b>{search_text}</b>'
 
-    msg.reply_text(result_text, parse_mode='HTML')
+    outbox.reply(msg, result_text, parse_mode='HTML')
 
     logger.debug("Exiting: item_search")
     return
@@ -408,54 +835,169 @@ def craft_inline(bot: Bot, update: Update, groups: tuple) -> None:
         logger.debug("Exiting: craft_inline")
         return
 
-    with orm.db_session:
-        item_name = dbItem[item_id].name
-
-    results = [
-        InlineQueryResultArticle(
-            id=uuid4(),
-            title=item_name,
-            input_message_content=InputTextMessageContent(f'/a_{item_id} {qty}')
-        )]
+    # the answer only depends on the query text, so Telegram may cache it for everyone
+    item = current_graph().get(item_id)
+    results = list()
+    if item:
+        results.append(InlineQueryResultArticle(
+            id=f'{item.id}-{qty}',
+            title=item.name,
+            description=f'x {qty}',
+            input_message_content=InputTextMessageContent(f'/a_{item.id} {qty}')
+        ))
 
-    update.inline_query.answer(results)
+    outbox.answer(update.inline_query, results, cache_time=config.INLINE_CACHE_TIME, is_personal=False)
 
     logger.debug("Exiting: craft_inline")
     return
 
 
-if __name__ == '__main__':
-    ud = Updater(config.TOKEN)
-    dp = ud.dispatcher
+def search_inline(bot: Bot, update: Update) -> None:
+    logger.debug("Entering: search_inline")
+
+    chat = update.effective_chat  # type: Chat
+    msg = update.effective_message  # type: Message
+    usr = update.effective_user  # type: User
+
+    query = update.inline_query
+    offset = int(query.offset) if query.offset.isdigit() else 0
+
+    items = current_graph().names.search(query.query.split())
+    page = items[offset:offset + config.INLINE_PAGE_SIZE]
+    next_offset = str(offset + len(page)) if offset + len(page) < len(items) else ''
+
+    results = list()
+    for item in page:
+        command = f'/{craft_command(item)}_{item.id}' if item.complex else f'/i_{item.id}'
+        results.append(InlineQueryResultArticle(
+            id=item.id,
+            title=item.name,
+            description=command,
+            input_message_content=InputTextMessageContent(command)
+        ))
 
+    outbox.answer(query, results, cache_time=config.INLINE_CACHE_TIME, is_personal=False, next_offset=next_offset)
+
+    logger.debug("Exiting: search_inline")
+    return
+
+
+def save_state(bot: Bot, update: Update) -> None:
+    # runs after every other handler, writes back the user and chat data they changed
+    user_data.save(update.effective_user.id if update.effective_user else None)
+    chat_data.save(update.effective_chat.id if update.effective_chat else None)
+
+
+def register_handlers(dp, shared=None) -> None:
+    # shared is the state backend workers share, in process when not given
+    global backend, user_data, chat_data
+    backend = shared or LocalBackend()
+    user_data = dp.user_data = PersistentData(backend, 'user')
+    chat_data = dp.chat_data = PersistentData(backend, 'chat')
+    dp.add_handler(TypeHandler(Update, save_state), group=100)
     dp.add_handler(TypeHandler(Update, dbhandler), group=-1)
 
     dp.add_handler(CommandHandler('start', start))
     dp.add_handler(CommandHandler('help', help))
     dp.add_handler(CommandHandler('ping', ping))
     dp.add_handler(CommandHandler('credits', credits))
+    dp.add_handler(CommandHandler('stats', stats))
     dp.add_handler(CommandHandler(['craft', 'items'], craft))
-
-    dp.add_handler(ConversationHandler(entry_points=[CommandHandler('submit', submit_recipe)],
-                                       states={
-                                           0: [MessageHandler(ForwardedFrom([408101137, 265204902]), process_recipe)]
-                                       },
-                                       fallbacks=[CommandHandler('cancel', cancel_recipe)]
-                                       )
-                   )
+    dp.add_handler(CommandHandler(['mats', 'bom'], bill_of_materials, pass_args=True))
+
+    submit = ConversationHandler(entry_points=[CommandHandler('submit', submit_recipe)],
+                                 states={
+                                     0: [MessageHandler(ForwardedFrom([408101137, 265204902]), process_recipe)]
+                                 },
+                                 fallbacks=[CommandHandler('cancel', cancel_recipe)]
+                                 )
+    # any worker may get the next message of a submission
+    submit.conversations = SharedConversations(backend, 'submit', config.CONVERSATION_TTL)
+    dp.add_handler(submit)
+
+    batch = ConversationHandler(entry_points=[CommandHandler('batch', batch_start, pass_user_data=True)],
+                                states={
+                                    0: [CommandHandler('done', batch_done, pass_user_data=True),
+                                        MessageHandler(Filters.text, batch_collect, pass_user_data=True)]
+                                },
+                                fallbacks=[CommandHandler('cancel', batch_cancel, pass_user_data=True)]
+                                )
+    batch.conversations = SharedConversations(backend, 'batch', config.CONVERSATION_TTL)
+    dp.add_handler(batch)
 
     dp.add_handler(MessageHandler(ForwardedFrom(user_id=408101137), process_stock))
+    dp.add_handler(CommandHandler(['need', 'missing'], missing_items, pass_args=True))
+    dp.add_handler(CommandHandler('history', stock_history, pass_args=True))
+    dp.add_handler(CommandHandler('guildstock', guild_stock, pass_args=True, pass_chat_data=True))
     dp.add_handler(CommandHandler(['search', 's', 'find'], item_search, pass_args=True))
-    dp.add_handler(MessageHandler(Filters.text, item_search))
-    dp.add_handler(CallbackQueryHandler(craft_list, pattern=r'^list\|(.*)', pass_groups=True))
-    dp.add_handler(RegexHandler(r'^/(?:craft|i|brew)_(.*)$', craft_cb, pass_groups=True))
+    dp.add_handler(MessageHandler(Filters.text & query_filter, item_search))
+    dp.add_handler(CallbackQueryHandler(craft_list, pattern=r'^list\|(\w+)(?:\|(\d+))?$', pass_groups=True))
+    dp.add_handler(CallbackQueryHandler(tree_cb, pattern=r'^tree\|(\w+)\|([\w.]*)\|(\d+)$', pass_groups=True))
+    dp.add_handler(RegexHandler(r'^/(craft|i|brew)_(\w*)(?:@\w+)?(?:\s+x?(\d+))?$', craft_cb, pass_groups=True))
+
+    dp.add_handler(InlineQueryHandler(craft_inline, pattern=r'^(\w{2,3})-(\d{1,3})$', pass_groups=True))
+    dp.add_handler(InlineQueryHandler(search_inline))
+
+
+def setup_metrics(dp) -> None:
+    handler_metrics.instrument_dispatcher(dp)
+    on_sql(handler_metrics.on_sql)
+    handler_metrics.gauge('cwcrafts_dispatcher_async_queue_depth', 'run_async jobs waiting for a dispatcher worker.',
+                          lambda: dp._Dispatcher__async_queue.qsize())
+    handler_metrics.gauge('cwcrafts_bot_api_pool', 'Bot API connection pool, opened keeps growing when too small.',
+                          lambda: pool_stats(dp.bot))
+    handler_metrics.gauge('cwcrafts_text_prefilter', 'Text messages let through to item search or dropped, by '
+                          'reason.', query_filter.stats)
+    handler_metrics.gauge('cwcrafts_render_cache', 'Rendered reply cache counters.', render_cache.stats)
+    handler_metrics.gauge('cwcrafts_outbox', 'Outgoing Bot API calls, pending ones are queued or waiting to retry.',
+                          outbox.stats)
+    handler_metrics.gauge('cwcrafts_user_writes', 'Write-behind user cache counters.', user_store.stats)
+
 
-    dp.add_handler(InlineQueryHandler(craft_inline, pattern=r'(\w{2,3})-(\d{1,3})', pass_groups=True))
+if __name__ == '__main__':
+    startup.mark('import')
+    time_binding(startup)
+    production = config.APP_ENV and config.APP_ENV.startswith('PROD')
+    if not production:
+        startup.expected = {'import', 'bind', 'mapping', 'polling'}
 
-    if config.APP_ENV.startswith('PROD'):
-        ud.start_webhook(listen='0.0.0.0', port=config.WEBHOOK_PORT, url_path=config.TOKEN)
-        ud.bot.set_webhook(url='https://{}/{}'.format(config.WEBHOOK_URL, config.TOKEN))
+    try:
+        # serve read-only commands from the last snapshot straight away and bind the database behind it
+        with startup.phase('snapshot'):
+            install_graph(load_snapshot(config.SNAPSHOT_PATH))
+        threading.Thread(target=refresh_graph, name='graph-refresh', daemon=True).start()
+    except (OSError, ValueError) as e:
+        logger.info("no usable recipe snapshot (%s), loading recipes from the database", e)
+        refresh_graph()
+
+    ud = Updater(bot=make_bot(config.TOKEN, config.DISPATCHER_WORKERS), workers=config.DISPATCHER_WORKERS)
+    dp = ud.dispatcher
+    if production and not config.SHARED_STATE_URL and config.STATE_PATH and not on_volume(config.STATE_PATH):
+        logger.error("STATE_PATH %s is not on a mounted volume, conversations and user data will be lost on the "
+                     "next redeploy; mount a volume there or set REDIS_URL", config.STATE_PATH)
+    register_handlers(dp, make_backend(config.SHARED_STATE_URL, config.STATE_PATH))
+    setup_metrics(dp)
+    backend.subscribe('recipes', recipes_published)
+
+    outbox.start()
+    ud.job_queue.run_repeating(lambda bot, job: user_store.flush(), config.USER_FLUSH_INTERVAL, name='user-flush')
+    if hasattr(backend, 'compact'):
+        ud.job_queue.run_repeating(lambda bot, job: backend.compact(), config.STATE_COMPACT_INTERVAL,
+                                   name='state-compact')
+
+    if production:
+        serve_on_webhook()
+        with startup.phase('webhook'):
+            ud.start_webhook(listen='0.0.0.0', port=config.WEBHOOK_PORT, url_path=config.TOKEN)
+            if config.WORKER_ID == 0:
+                ud.bot.set_webhook(url='https://{}/{}'.format(config.webhook_url(), config.TOKEN))
     else:
-        ud.start_polling(clean=True)
+        if config.METRICS_PORT:
+            serve_standalone(config.METRICS_PORT)
+        with startup.phase('polling'):
+            ud.start_polling(clean=True)
     ud.idle()
-
+    outbox.stop()
+    user_store.flush()
+    if hasattr(backend, 'close'):
+        backend.close()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import logging
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+import config
+
+logger = logging.getLogger("cw-crafts-bot")
+
+
+def pool_size(workers: int) -> int:
+    # a connection for every thread that may call the Bot API at the same time: the dispatcher workers, the
+    # outbox workers, the dispatcher itself, the updater, the job queue and the main thread
+    return config.BOT_API_POOL_SIZE or workers + config.OUTBOX_WORKERS + 4
+
+
+def make_bot(token: str, workers: int, base_url: str = None) -> Bot:
+    request = Request(con_pool_size=pool_size(workers),
+                      connect_timeout=config.BOT_API_CONNECT_TIMEOUT,
+                      read_timeout=config.BOT_API_READ_TIMEOUT)
+    logger.debug("Bot API connection pool size %d", request.con_pool_size)
+    return Bot(token, base_url, request=request)
+
+
+def pool_stats(bot: Bot) -> dict:
+    """Connection pool usage of a bot made by make_bot, summed over the hosts it has talked to."""
+    manager = bot.request._con_pool
+    with manager.pools.lock:
+        pools = list(manager.pools._container.values())
+
+    stats = {'size': bot.request.con_pool_size, 'in_use': 0, 'idle': 0, 'opened': 0, 'requests': 0}
+    for pool in pools:
+        queue = pool.pool
+        if queue is None:  # closed
+            continue
+        idle = sum(1 for conn in list(queue.queue) if conn is not None)
+        stats['in_use'] += queue.maxsize - queue.qsize()
+        stats['idle'] += idle
+        stats['opened'] += pool.num_connections
+        stats['requests'] += pool.num_requests
+    return stats
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from graph import current_graph
+
+import config
+
+
+class RenderCache:
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+        self._data = OrderedDict()  # (item_id, kind) -> (expires, text)
+        self._keys = defaultdict(set)  # item_id -> cached keys
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, item_id: str, kind):
+        key = (item_id, kind)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, item_id: str, kind, text: str, graph=None) -> None:
+        # graph is the one text was rendered from; once another graph is installed, an invalidation for the change
+        # may already have run, so the text is not kept
+        key = (item_id, kind)
+        with self._lock:
+            if graph is not None and graph is not current_graph():
+                self.stale += 1
+                return
+            self._data[key] = (time.monotonic() + self.ttl, text)
+            self._data.move_to_end(key)
+            self._keys[item_id].add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate(self, item_ids) -> None:
+        with self._lock:
+            for item_id in item_ids:
+                for key in self._keys.pop(item_id, ()):
+                    del self._data[key]
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+            self._keys.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'stale': self.stale}
+
+    def _remove(self, key) -> None:
+        del self._data[key]
+        keys = self._keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys[key[0]]
+
+
+render_cache = RenderCache(config.RENDER_CACHE_SIZE, config.RENDER_CACHE_TTL)
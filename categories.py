@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+CATEGORIES = ('all', 'basic', 'complex', 'armour', 'weapon', 'recipe', 'fragment', 'potion', 'herb')
+
+_prefixes = {'a': 'armour', 'w': 'weapon', 'r': 'recipe', 'k': 'fragment', 'p': 'potion'}
+
+
+def is_herb(item_id: str) -> bool:
+    return item_id.isdigit() and 39 <= int(item_id) <= 69
+
+
+def categorize(item) -> tuple:
+    categories = ['all', 'complex' if item.complex else 'basic']
+    if item.id[:1] in _prefixes:
+        categories.append(_prefixes[item.id[:1]])
+    elif is_herb(item.id):
+        categories.append('herb')
+    return tuple(categories)
+
+
+def craft_command(item) -> str:
+    return 'brew' if is_herb(item.id) or item.id.startswith('p') else 'craft'
+
+
+def render_item_line(item) -> str:
+    line = '<code>{:>3}</code> - {}'.format(item.id, item.name)
+    line += ' (/{}_{})\n'.format(craft_command(item), item.id) if item.complex else '\n'
+    return line
+
+
+class Catalogue:
+    def __init__(self, items, page_size: int):
+        members = {category: list() for category in CATEGORIES}
+        for item in sorted(items, key=lambda i: i.id):
+            for category in categorize(item):
+                members[category].append(item)
+        self.members = {k: tuple(v) for k, v in members.items()}
+        self.page_size = page_size
+        self._pages = dict()
+
+    def page_count(self, category: str) -> int:
+        return max(1, -(-len(self.members.get(category, ())) // self.page_size))
+
+    def page(self, category: str, page: int) -> str:
+        # pages are 1-based and rendered on first request, the snapshot is replaced when the catalogue changes
+        text = self._pages.get((category, page))
+        if text is None:
+            pages = self.page_count(category)
+            start = (page - 1) * self.page_size
+            text = '<b>{} items</b>'.format(category.title())
+            text += ' ({}/{})\n'.format(page, pages) if pages > 1 else '\n'
+            text += ''.join(render_item_line(i) for i in self.members.get(category, ())[start:start + self.page_size])
+            if category in self.members:
+                self._pages[(category, page)] = text
+        return text
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import os
-import requests
+from functools import lru_cache
 
 TOKEN = os.getenv('BOT_TOKEN')
 APP_ENV = os.getenv('APP_ENV')
@@ -10,6 +10,41 @@ DB_PASS = os.getenv('DATABASE_PASSWORD')
 DB_HOST = os.getenv('DATABASE_SERVICE_NAME')
 DB_NAME = os.getenv('DATABASE_NAME')
 
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', 512))
+RENDER_CACHE_TTL = int(os.getenv('RENDER_CACHE_TTL', 3600))
+MAX_TREE_LINES = int(os.getenv('MAX_TREE_LINES', 40))  # longer craft trees are shown collapsed
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', 40))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 3600))
+INLINE_PAGE_SIZE = int(os.getenv('INLINE_PAGE_SIZE', 20))  # Telegram allows up to 50
+QUERY_MAX_LENGTH = int(os.getenv('QUERY_MAX_LENGTH', 64))  # longer text messages are not item searches
+QUERY_MAX_WORDS = int(os.getenv('QUERY_MAX_WORDS', 6))
+QUERY_DEBOUNCE = float(os.getenv('QUERY_DEBOUNCE', 10))  # seconds before the same search is answered again
+STOCK_HISTORY_LIMIT = int(os.getenv('STOCK_HISTORY_LIMIT', 500))  # older stock snapshots are merged together
+STOCK_TREND_POINTS = int(os.getenv('STOCK_TREND_POINTS', 10))
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'recipes.snapshot')
+GRAPH_RETRY_MAX_DELAY = float(os.getenv('GRAPH_RETRY_MAX_DELAY', 60))  # seconds between database reload attempts
+
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', 30))
+DISPATCHER_WORKERS = int(os.getenv('DISPATCHER_WORKERS', 4))
+BOT_API_POOL_SIZE = int(os.getenv('BOT_API_POOL_SIZE', 0))  # 0 sizes the pool from the worker counts
+BOT_API_CONNECT_TIMEOUT = float(os.getenv('BOT_API_CONNECT_TIMEOUT', 5))
+BOT_API_READ_TIMEOUT = float(os.getenv('BOT_API_READ_TIMEOUT', 10))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 4))
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 30))  # messages per second, 0 for no limit
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = float(os.getenv('OUTBOX_CHAT_BURST', 3))
+OUTBOX_GROUP_RATE = float(os.getenv('OUTBOX_GROUP_RATE', 20 / 60))
+OUTBOX_RETRIES = int(os.getenv('OUTBOX_RETRIES', 3))
+SHARED_STATE_URL = os.getenv('REDIS_URL')  # workers only share state when set
+# worker 0 registers the webhook and writes the recipe snapshot, Heroku numbers its dynos from web.1
+WORKER_ID = int(os.getenv('WORKER_ID', int(os.getenv('DYNO', 'web.1').rsplit('.', 1)[-1]) - 1))
+# without REDIS_URL, conversations and user data are kept here; in a container this must be on a mounted volume,
+# Heroku dynos have none and need REDIS_URL
+STATE_PATH = os.getenv('STATE_PATH', 'state')
+STATE_COMPACT_INTERVAL = float(os.getenv('STATE_COMPACT_INTERVAL', 300))
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', 86400))
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # only used when polling, webhooks serve /metrics themselves
+
 if APP_ENV == 'PROD_OPENSHIFT':
     LOGLEVEL = os.getenv('LOGLEVEL', 'INFO')
     os_namespace = os.getenv("OPENSHIFT_BUILD_NAMESPACE")
@@ -19,13 +54,7 @@ if APP_ENV == 'PROD_OPENSHIFT':
                  'password': DB_PASS,
                  'host': DB_HOST,
                  'database': DB_NAME}
-    with open("/var/run/secrets/kubernetes.io/serviceaccount/token") as f:
-        os_api_token = f.read()
-    os_api_url = "https://openshift.default.svc.cluster.local/oapi/v1/"
-    os_api_crt = "/var/run/secrets/kubernetes.io/serviceaccount/ca.crt"
-    headers = {'Authorization': 'Bearer {}'.format(os_api_token)}
-    r = requests.get(f"{os_api_url}namespaces/{os_namespace}/routes/{os_app_name}", headers=headers, verify=os_api_crt)
-    WEBHOOK_URL = r.json()["spec"]["host"]
+    WEBHOOK_URL = None  # looked up from the OpenShift route by webhook_url() when the webhook is registered
     WEBHOOK_PORT = int(os.getenv("{}_SERVICE_PORT_WEB".format(os_app_name.upper().replace('-', '_'))))
 elif APP_ENV == 'PROD_HEROKU':
     LOGLEVEL = os.getenv('LOGLEVEL', 'INFO')
@@ -38,3 +67,17 @@ else:
     LOGLEVEL = 'DEBUG'
     DB_PARAMS = {'provider': 'postgres',
                  'dsn': os.getenv('DATABASE_URL')}
+
+
+@lru_cache(maxsize=None)
+def webhook_url() -> str:
+    if WEBHOOK_URL or APP_ENV != 'PROD_OPENSHIFT':
+        return WEBHOOK_URL
+    import requests
+    with open("/var/run/secrets/kubernetes.io/serviceaccount/token") as f:
+        os_api_token = f.read()
+    os_api_url = "https://openshift.default.svc.cluster.local/oapi/v1/"
+    os_api_crt = "/var/run/secrets/kubernetes.io/serviceaccount/ca.crt"
+    headers = {'Authorization': 'Bearer {}'.format(os_api_token)}
+    r = requests.get(f"{os_api_url}namespaces/{os_namespace}/routes/{os_app_name}", headers=headers, verify=os_api_crt)
+    return r.json()["spec"]["host"]
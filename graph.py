@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+from collections import namedtuple, defaultdict
+from functools import cached_property
+
+from search import NameIndex
+from categories import Catalogue
+
+import config
+
+logger = logging.getLogger("cw-crafts-bot")
+
+GraphItem = namedtuple('GraphItem', ['id', 'name', 'complex'])
+Edge = namedtuple('Edge', ['recipe_id', 'result', 'ingredient', 'qty'])
+# order: item ids sorted by depth, so ingredients come before what they are used in
+# depth: item id -> longest chain of recipes below it, 0 for items without a recipe
+# size: item id -> lines gen_craft_tree renders for one of it
+Shape = namedtuple('Shape', ['order', 'depth', 'size'])
+
+
+class RecipeCycleError(ValueError):
+    def __init__(self, cycle: list):
+        self.cycle = cycle
+        super().__init__('recipe cycle: {}'.format(' -> '.join(cycle)))
+
+
+def find_cycle(requires: dict):
+    # requires maps an item id to the ids it is crafted from, returns [a, b, ..., a] for a cycle or None
+    state = dict()  # item id -> 1 while on the current path, 2 once everything below it was visited
+    for start in sorted(requires):
+        if start in state:
+            continue
+        state[start] = 1
+        path, pending = [start], [iter(sorted(requires[start]))]
+        while path:
+            item = next(pending[-1], None)
+            if item is None:
+                state[path.pop()] = 2
+                pending.pop()
+            elif state.get(item) == 1:
+                return path[path.index(item):] + [item]
+            elif item not in state:
+                state[item] = 1
+                path.append(item)
+                pending.append(iter(sorted(requires.get(item, ()))))
+    return None
+
+
+class RecipeGraph:
+    """Read-only snapshot of the Item/Recipe tables. Never mutate one in place, build a new one and swap it."""
+
+    def __init__(self, items, edges):
+        self.items = {i.id: i for i in items}
+        self.edges = tuple(sorted(edges, key=lambda e: e.recipe_id))
+
+        result_of = defaultdict(list)
+        ingredient_in = defaultdict(list)
+        for e in self.edges:
+            result_of[e.result].append(e)
+            ingredient_in[e.ingredient].append(e)
+
+        # the top level of a craft tree is ordered by ingredient id, nested levels by recipe (creation) order
+        self.result_of = {k: tuple(v) for k, v in result_of.items()}
+        self.components = {k: tuple(sorted(v, key=lambda e: e.ingredient)) for k, v in result_of.items()}
+        self.ingredient_in = {k: tuple(sorted(v, key=lambda e: e.result)) for k, v in ingredient_in.items()}
+        self._bom = dict()
+
+    def __contains__(self, item_id) -> bool:
+        return item_id in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+    @cached_property
+    def names(self) -> NameIndex:
+        return NameIndex(self.items.values())
+
+    @cached_property
+    def categories(self) -> Catalogue:
+        return Catalogue(self.items.values(), config.LIST_PAGE_SIZE)
+
+    @cached_property
+    def shape(self) -> Shape:
+        # items on a cycle, or crafted from one, are left out
+        remaining = {k: len({e.ingredient for e in v}) for k, v in self.result_of.items()}
+        ready = [i for i in sorted(self.items) if i not in remaining]
+        depth = dict.fromkeys(ready, 0)
+        size = dict.fromkeys(ready, 0)
+        while ready:
+            item = ready.pop()
+            for result in sorted({e.result for e in self.ingredient_in.get(item, ())}):
+                remaining[result] -= 1
+                if not remaining[result]:
+                    parts = self.result_of[result]
+                    depth[result] = 1 + max(depth[e.ingredient] for e in parts)
+                    size[result] = sum(1 + (size[e.ingredient] if self.items[e.ingredient].complex else 0)
+                                       for e in parts)
+                    ready.append(result)
+        return Shape(tuple(sorted(depth, key=lambda i: (depth[i], i))), depth, size)
+
+    @cached_property
+    def cycle(self):
+        if len(self.shape.depth) == len(self.items):
+            return None
+        return find_cycle({k: {e.ingredient for e in v} for k, v in self.result_of.items()})
+
+    def cycle_with(self, pairs):
+        # the cycle adding these (result id, ingredient id) recipe parts would create, or None
+        requires = {k: {e.ingredient for e in v} for k, v in self.result_of.items()}
+        for result, ingredient in pairs:
+            requires.setdefault(result, set()).add(ingredient)
+        return find_cycle(requires)
+
+    def check(self) -> None:
+        if self.cycle:
+            raise RecipeCycleError(self.cycle)
+
+    def dependents(self, item_ids) -> set:
+        # the given items plus everything whose craft tree contains one of them
+        seen = set(item_ids)
+        stack = list(seen)
+        while stack:
+            for e in self.ingredient_in.get(stack.pop(), ()):
+                if e.result not in seen:
+                    seen.add(e.result)
+                    stack.append(e.result)
+        return seen
+
+    def bill_of_materials(self, item_id: str, qty: int = 1) -> tuple:
+        # aggregated (item_id, qty) of everything that is not crafted further, sorted by item id
+        return tuple((i, n * qty) for i, n in self._materials(item_id, top=True))
+
+    def _expands(self, item_id: str) -> bool:
+        # like gen_craft_tree, only complex items are broken down into their ingredients
+        return item_id in self.result_of and self.items[item_id].complex
+
+    def _materials(self, item_id: str, top: bool = False) -> tuple:
+        key = (item_id, top)
+        bom = self._bom.get(key)
+        if bom is None:
+            if item_id in self.result_of if top else self._expands(item_id):
+                totals = defaultdict(int)
+                for e in self.result_of[item_id]:
+                    for i, n in self._materials(e.ingredient):
+                        totals[i] += n * e.qty
+                bom = tuple(sorted(totals.items()))
+            else:
+                # basic items, and complex items nobody has submitted a recipe for yet, are bought as-is
+                bom = ((item_id, 1),)
+            self._bom[key] = bom
+        return bom
+
+    def craftable(self, stock: dict) -> dict:
+        # item id -> how many times it can be crafted straight from stock, in one pass over the recipe parts
+        times = dict()
+        for e in self.edges:
+            n = stock.get(e.ingredient, 0) // e.qty
+            times[e.result] = min(times.get(e.result, n), n)
+        return {k: v for k, v in sorted(times.items()) if v > 0}
+
+    def missing(self, item_id: str, stock: dict, count: int = 1) -> tuple:
+        # (item_id, qty) still needed to craft count x item_id, crafting intermediates from stock where possible
+        available = dict(stock)
+        deficit = defaultdict(int)
+        stack = [(e.ingredient, e.qty * count) for e in self.result_of.get(item_id, ())]
+        while stack:
+            ingr, qty = stack.pop()
+            used = min(available.get(ingr, 0), qty)
+            available[ingr] = available.get(ingr, 0) - used
+            qty -= used
+            if not qty:
+                continue
+            if self._expands(ingr):
+                stack.extend((e.ingredient, e.qty * qty) for e in self.result_of[ingr])
+            else:
+                deficit[ingr] += qty
+        return tuple(sorted(deficit.items()))
+
+    def with_edges(self, edges) -> 'RecipeGraph':
+        graph = RecipeGraph(self.items.values(), self.edges + tuple(edges))
+        for index in ('names', 'categories'):
+            if index in self.__dict__:
+                setattr(graph, index, getattr(self, index))  # same items, the item indexes carry over
+        return graph
+
+
+_graph = RecipeGraph((), ())
+_lock = threading.Lock()
+_loading = None  # while load_graph reads the tables, the edges add_edges applied in the meantime
+
+
+def current_graph() -> RecipeGraph:
+    return _graph
+
+
+def _swap(graph: RecipeGraph) -> RecipeGraph:
+    global _graph
+    _graph = graph
+    return graph
+
+
+def install_graph(graph: RecipeGraph) -> RecipeGraph:
+    global _loading
+    # build the item indexes before the snapshot goes live
+    graph.names
+    graph.categories
+    if graph.cycle:
+        logger.error("recipe graph has a cycle, affected items cannot be rendered: %s", ' -> '.join(graph.cycle))
+    with _lock:
+        if _loading:
+            # recipes added after the tables were read would be lost otherwise
+            known = {e.recipe_id for e in graph.edges}
+            late = [e for e in _loading if e.recipe_id not in known]
+            if late:
+                graph = graph.with_edges(late)
+        _loading = None
+        _swap(graph)
+    logger.info("recipe graph installed: %d items, %d recipe parts", len(graph.items), len(graph.edges))
+    return graph
+
+
+def load_graph() -> RecipeGraph:
+    global _loading
+    from pony import orm
+    from models import Item, Recipe, bind
+    bind()
+    with _lock:
+        _loading = list()
+    try:
+        with orm.db_session:
+            items = [GraphItem(*row) for row in orm.select((i.id, i.name, i.complex) for i in Item)]
+            edges = [Edge(*row) for row in orm.select((r.id, r.result_item.id, r.ingredient_item.id, r.quantity_req)
+                                                      for r in Recipe)]
+    except Exception:
+        with _lock:
+            _loading = None
+        raise
+    return install_graph(RecipeGraph(items, edges))
+
+
+def add_edges(edges) -> RecipeGraph:
+    with _lock:
+        graph = current_graph()
+        known = {e.recipe_id for e in graph.edges}
+        edges = [e for e in edges if e.recipe_id not in known]  # another worker's edges may be loaded already
+        if _loading is not None:
+            _loading.extend(edges)
+        return _swap(graph.with_edges(edges)) if edges else graph
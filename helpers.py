@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
-from collections import deque, defaultdict
+from collections import deque
 
 from telegram.ext import BaseFilter
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from models import Item, Recipe
+from graph import RecipeGraph
+from cache import render_cache
+from consts import item_filter_kb
+
+import config
 
 
 class ForwardedFrom(BaseFilter):
@@ -24,29 +28,94 @@ class ForwardedFrom(BaseFilter):
         return False
 
 
-def gen_craft_tree(item: Item) -> str:
-    output_list = str()
-    shopping_list = defaultdict(int)
+def gen_craft_tree(graph: RecipeGraph, item_id: str, count: int = 1, level: int = 0) -> str:
+    # level > 0 renders a subtree the way it appears nested in a bigger tree
+    lines = [None] * graph.shape.size[item_id]
     mystack = deque()
-    for i in item.result_of.order_by(lambda i: i.ingredient_item.id):
-        mystack.appendleft((i, 0, i.quantity_req))
+    for i in (graph.components if level == 0 else graph.result_of).get(item_id, ()):
+        mystack.appendleft((i, level, count*i.qty))
+    n = 0
     while mystack:
         t, l, qty = mystack.popleft()
-        t = t.ingredient_item
+        t = graph.items[t.ingredient]
         if t.complex:
-            for i in t.result_of.order_by(lambda i: i.id):
-                mystack.appendleft((i, l+1, qty*i.quantity_req))
-        else:
-            shopping_list[t.name] += qty
-        output_list += '<code>{}{} x {}</code>\n'.format('  '*l, qty, t.name)
-#        pprint(shopping_list)
+            for i in graph.result_of.get(t.id, ()):
+                mystack.appendleft((i, l+1, qty*i.qty))
+        lines[n] = '<code>{}{} x {}</code>\n'.format('  '*l, qty, t.name)
+        n += 1
+    return ''.join(lines)
+
+
+def tree_fragment(graph: RecipeGraph, item_id: str, count: int, level: int) -> str:
+    fragment = render_cache.get(item_id, ('fragment', count, level))
+    if fragment is None:
+        fragment = gen_craft_tree(graph, item_id, count, level)
+        render_cache.put(item_id, ('fragment', count, level), fragment, graph)
+    return fragment
+
+
+def gen_tree_view(graph: RecipeGraph, item_id: str, path: tuple = (), count: int = 1) -> tuple:
+    """The top level of a craft tree, with each item on path opened one level below the previous one.
+
+    The last item on path is opened all the way down when its subtree has at most config.MAX_TREE_LINES lines.
+    Returns the text and the keyboard rows to open (or close) the next level.
+    """
+    lines = list()
+    openable = list()
+
+    def walk(node, level, qty):
+        parts = graph.components if level == 0 else graph.result_of
+        for e in reversed(parts.get(node, ())):
+            item = graph.items[e.ingredient]
+            n = qty * e.qty
+            # only the level below the last opened item gets buttons, so only it is marked
+            nested = item.complex and item.id in graph.result_of and level == len(path)
+            if level < len(path) and path[level] == item.id:
+                lines.append('<code>{}{} x {}</code>\n'.format('  ' * level, n, item.name))
+                if level == len(path) - 1 and graph.shape.size[item.id] <= config.MAX_TREE_LINES:
+                    lines.append(tree_fragment(graph, item.id, n, level + 1))
+                else:
+                    walk(item.id, level + 1, n)
+            else:
+                lines.append('<code>{}{} x {}</code>{}\n'.format('  ' * level, n, item.name, ' ▸' if nested else ''))
+                if nested:
+                    openable.append(item)
+
+    walk(item_id, 0, count)
+
+    def button(text, opened):
+        data = 'tree|{}|{}|{}'.format(item_id, '.'.join(opened), count)
+        return [InlineKeyboardButton(text, callback_data=data)] if len(data.encode('utf-8')) <= 64 else []
+
+    keyboard = [row for row in (button('▸ ' + i.name, path + (i.id,)) for i in openable) if row]
+    if path:
+        keyboard.append(button('▴ Close ' + graph.items[path[-1]].name, path[:-1]))
+    return ''.join(lines), keyboard
+
+
+def gen_shopping_list(graph: RecipeGraph, item_id: str, count: int = 1) -> str:
+    output_list = str()
+    for i, qty in graph.bill_of_materials(item_id, count):
+        output_list += '<code>{:>4} x {}</code>\n'.format(qty, graph.items[i].name)
     return output_list
 
 
-def build_craft_kb(item: Item) -> InlineKeyboardMarkup:
+def build_craft_kb(graph: RecipeGraph, item_id: str) -> InlineKeyboardMarkup:
     keyboard = []
-    for ingr in item.result_of:
-        qty = ingr.quantity_req
-        ingr = ingr.ingredient_item
+    for ingr in graph.result_of.get(item_id, ()):
+        qty = ingr.qty
+        ingr = graph.items[ingr.ingredient]
         keyboard.append([InlineKeyboardButton(text=f'{ingr.name}', switch_inline_query=f'{ingr.id}-{qty}')])
     return InlineKeyboardMarkup(keyboard)
+
+
+def build_list_kb(item_filter: str, page: int, pages: int) -> InlineKeyboardMarkup:
+    keyboard = list(item_filter_kb)
+    if pages > 1:
+        nav = []
+        if page > 1:
+            nav.append(InlineKeyboardButton('« Prev', callback_data=f'list|{item_filter}|{page - 1}'))
+        if page < pages:
+            nav.append(InlineKeyboardButton('Next »', callback_data=f'list|{item_filter}|{page + 1}'))
+        keyboard.append(nav)
+    return InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+logger = logging.getLogger("cw-crafts-bot")
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for n, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[n] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class HandlerMetrics:
+    """Per handler duration histograms and Pony query counts, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.durations = defaultdict(Histogram)
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.queries = defaultdict(int)
+        self.query_seconds = defaultdict(float)
+        self.gauges = list()  # (name, help, fn returning a number or {label: number})
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def instrument(self, fn, name: str = None):
+        name = name or fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            outer = getattr(self._local, 'handler', None)
+            self._local.handler = name
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.errors[name] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                self._local.handler = outer
+                with self._lock:
+                    self.calls[name] += 1
+                    self.durations[name].observe(elapsed)
+        return wrapper
+
+    def instrument_dispatcher(self, dp) -> None:
+        # wrap the callback of every registered handler, including the ones nested in conversations
+        def wrap(handler):
+            if hasattr(handler, 'entry_points'):
+                for nested in handler.entry_points + handler.fallbacks:
+                    wrap(nested)
+                for state_handlers in handler.states.values():
+                    for nested in state_handlers:
+                        wrap(nested)
+            elif not getattr(handler.callback, '_instrumented', False):
+                handler.callback = self.instrument(handler.callback)
+                handler.callback._instrumented = True
+
+        for group in dp.groups:
+            for handler in dp.handlers[group]:
+                wrap(handler)
+
+    def on_sql(self, sql: str, elapsed: float) -> None:
+        name = getattr(self._local, 'handler', None) or 'background'
+        with self._lock:
+            self.queries[name] += 1
+            self.query_seconds[name] += elapsed
+
+    def gauge(self, name: str, help_text: str, fn) -> None:
+        self.gauges.append((name, help_text, fn))
+
+    def render(self) -> str:
+        lines = list()
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            family('cwcrafts_handler_duration_seconds', 'histogram', 'Time spent in each update handler.')
+            for handler, hist in sorted(self.durations.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, hist.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'cwcrafts_handler_duration_seconds_bucket{{handler="{handler}",le="{le}"}} {cumulative}')
+                lines.append(f'cwcrafts_handler_duration_seconds_sum{{handler="{handler}"}} {hist.sum}')
+                lines.append(f'cwcrafts_handler_duration_seconds_count{{handler="{handler}"}} {hist.count}')
+
+            for name, help_text, values in (
+                    ('cwcrafts_handler_errors_total', 'Exceptions raised by each update handler.', self.errors),
+                    ('cwcrafts_handler_queries_total', 'SQL statements executed by each handler.', self.queries),
+                    ('cwcrafts_handler_query_seconds_total', 'Time spent in SQL by each handler.',
+                     self.query_seconds)):
+                family(name, 'counter', help_text)
+                for handler, value in sorted(values.items()):
+                    lines.append(f'{name}{{handler="{handler}"}} {value}')
+
+        for name, help_text, fn in self.gauges:
+            try:
+                value = fn()
+            except Exception:
+                logger.exception("failed to collect metric %s", name)
+                continue
+            family(name, 'gauge', help_text)
+            if isinstance(value, dict):
+                for label, v in sorted(value.items()):
+                    lines.append(f'{name}{{kind="{label}"}} {v}')
+            else:
+                lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def metrics_handler(base):
+    # extend an http.server request handler class so GET /metrics answers with the current metrics
+    class MetricsHandler(base):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                if hasattr(base, 'do_GET'):
+                    return base.do_GET(self)
+                return self.send_error(404)
+            payload = handler_metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return MetricsHandler
+
+
+def serve_on_webhook() -> None:
+    # the Updater builds its webhook server from the module level WebhookHandler name
+    import telegram.ext.updater
+    telegram.ext.updater.WebhookHandler = metrics_handler(telegram.ext.updater.WebhookHandler)
+
+
+def serve_standalone(port: int) -> None:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    httpd = ThreadingHTTPServer(('0.0.0.0', port), metrics_handler(BaseHTTPRequestHandler))
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    logger.info("serving metrics on port %d", port)
+
+
+handler_metrics = HandlerMetrics()
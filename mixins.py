@@ -5,6 +5,14 @@ from pony import orm
 
 
 class TgMixin:
+    @classmethod
+    def to_params(cls, obj) -> dict:
+        if isinstance(obj, User):
+            params = obj.to_dict()
+        elif isinstance(obj, dict):
+            params = obj
+        return {k.name: params.get(k.name, k.py_type()) for k in cls._attrs_ if not k.is_relation}
+
     @classmethod
     def update_or_create(cls, obj):
         if isinstance(obj, User):
@@ -22,8 +30,32 @@ class TgMixin:
             # if object not found, create and return it
             return cls(**params)
         else:
-            # else it was found, lets update existing params and unset missing params
-            newparams = {k.name: params.setdefault(k.name, k.py_type()) for k in cls._attrs_}
+            # else it was found, lets update existing params and unset missing params, leaving relations alone
+            newparams = {k.name: params.setdefault(k.name, k.py_type()) for k in cls._attrs_ if not k.is_relation}
             instance.set(**newparams)
 
             return instance
+
+    @classmethod
+    def bulk_upsert(cls, rows: list) -> None:
+        # one INSERT ... ON CONFLICT DO UPDATE for many to_params() dicts, must be called inside a db_session
+        if not rows:
+            return
+        db = cls._database_
+        quote = db.provider.quote_name
+        attrs = [k for k in cls._attrs_ if not k.is_relation]
+        columns = ', '.join(quote(k.column) for k in attrs)
+        conflict = ', '.join(quote(k.column) for k in cls._pk_attrs_)
+        updates = ', '.join('{0} = excluded.{0}'.format(quote(k.column)) for k in attrs if not k.is_pk)
+        values = [tuple(row[k.name] for k in attrs) for row in rows]
+
+        cursor = db.get_connection().cursor()
+        if db.provider_name == 'postgres':
+            from psycopg2.extras import execute_values
+            sql = 'INSERT INTO {} ({}) VALUES %s ON CONFLICT ({}) DO UPDATE SET {}'.format(
+                quote(cls._table_), columns, conflict, updates)
+            execute_values(cursor, sql, values, page_size=500)
+        else:
+            sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}'.format(
+                quote(cls._table_), columns, ', '.join('?' * len(attrs)), conflict, updates)
+            cursor.executemany(sql, values)
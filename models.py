@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+
 from pony import orm
 from mixins import TgMixin
 
@@ -15,6 +20,8 @@ class User(db.Entity, TgMixin):
     last_name = orm.Optional(str)
     username = orm.Optional(str)
     language_code = orm.Optional(str)
+    stock = orm.Optional('Stock')
+    stock_history = orm.Optional('StockHistory')
 
 
 class Item(db.Entity):
@@ -32,32 +39,135 @@ class Recipe(db.Entity):
     orm.composite_key(result_item, ingredient_item)
 
 
-if not config.APP_ENV.startswith('PROD'):
-    orm.set_sql_debug(True)
+class Stock(db.Entity):
+    user = orm.PrimaryKey(User)
+    items = orm.Required(orm.Json)  # item id -> quantity, as parsed from the last forwarded /more
+    updated = orm.Required(datetime)
 
-db.bind(**config.DB_PARAMS)
-db.generate_mapping(create_tables=True)
 
+class StockHistory(db.Entity):
+    user = orm.PrimaryKey(User)
+    slots = orm.Required(orm.Json)  # item ids in the order they first appeared, records refer to them by index
+    records = orm.Required(bytes)  # every forwarded /more as a change against the one before, see stockhistory.py
+    snapshots = orm.Required(int)
+    updated = orm.Required(datetime)
 
-def dataload():
+
+_bind_lock = threading.RLock()
+_bind_timer = None
+
+
+def time_binding(timer) -> None:
+    # record 'bind' and 'mapping' on timer, whichever handler or job ends up binding first
+    global _bind_timer
+    _bind_timer = timer
+
+
+def bind() -> None:
+    # binding and mapping happen on first use rather than at import, so importing models needs no database
+    with _bind_lock:
+        if db.schema is not None:
+            return
+        if not config.APP_ENV or not config.APP_ENV.startswith('PROD'):
+            orm.set_sql_debug(True)
+        start = time.perf_counter()
+        if db.provider is None:
+            db.bind(**config.DB_PARAMS)
+        bound = time.perf_counter()
+        db.generate_mapping(create_tables=True)
+        timer = _bind_timer
+        if timer is not None:
+            timer.record('bind', start, bound)
+            timer.record('mapping', bound, time.perf_counter())
+
+
+_sql_listeners = list()
+
+
+def on_sql(listener) -> None:
+    # listener(sql, seconds) is called after every statement pony executes, eg. for query counts
+    if not _sql_listeners:
+        exec_sql = db._exec_sql
+
+        def timed_exec_sql(sql, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return exec_sql(sql, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                for notify in _sql_listeners:
+                    notify(sql, elapsed)
+
+        db._exec_sql = timed_exec_sql
+    _sql_listeners.append(listener)
+
+
+def needs_db(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        bind()
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+@needs_db
+def sync_data(path: str = 'data.json', delete: bool = False) -> dict:
+    # make the Item/Recipe tables match data.json in one transaction, deleting rows missing from it if asked to
     import json
-    with open('data.json', 'r') as fp:
+    from graph import find_cycle, RecipeCycleError
+    with open(path, 'r') as fp:
         data = json.load(fp)
 
-    for item in data["items"]:
-        with orm.db_session:
-            try:
-                Item[item["id"]]
-            except orm.core.ObjectNotFound:
-                    Item(**item)
-
-    for recipe in data["recipes"]:
-        with orm.db_session:
-            item = Item[recipe["id"]]
-            for i in recipe["ingredients"]:
-                qty = i[0]
-                ingr = Item[i[1]]
-                try:
-                    Recipe(result_item=item, ingredient_item=ingr, quantity_req=qty)
-                except orm.core.TransactionIntegrityError:
-                    continue
+    items = {item["id"]: item for item in data["items"]}
+    recipes = {(recipe["id"], ingr): qty for recipe in data["recipes"] for qty, ingr in recipe["ingredients"]}
+    counts = dict.fromkeys(('items_added', 'items_updated', 'items_deleted',
+                            'recipes_added', 'recipes_updated', 'recipes_deleted'), 0)
+
+    with orm.db_session:
+        db_items = {i.id: i for i in Item.select()}
+        db_recipes = {(r.result_item.id, r.ingredient_item.id): r for r in Recipe.select()}
+
+        requires = dict()
+        for result_id, ingr_id in recipes.keys() | (set() if delete else db_recipes.keys()):
+            requires.setdefault(result_id, set()).add(ingr_id)
+        cycle = find_cycle(requires)
+        if cycle:
+            raise RecipeCycleError(cycle)
+
+        for item_id, item in items.items():
+            params = {'name': item["name"], 'complex': item.get("complex", False)}
+            if item_id not in db_items:
+                db_items[item_id] = Item(id=item_id, **params)
+                counts['items_added'] += 1
+            elif (db_items[item_id].name, db_items[item_id].complex) != (params['name'], params['complex']):
+                db_items[item_id].set(**params)
+                counts['items_updated'] += 1
+
+        for (result_id, ingr_id), qty in recipes.items():
+            if (result_id, ingr_id) not in db_recipes:
+                Recipe(result_item=db_items[result_id], ingredient_item=db_items[ingr_id], quantity_req=qty)
+                counts['recipes_added'] += 1
+            elif db_recipes[(result_id, ingr_id)].quantity_req != qty:
+                db_recipes[(result_id, ingr_id)].quantity_req = qty
+                counts['recipes_updated'] += 1
+
+        if delete:
+            for key, recipe in db_recipes.items():
+                if key not in recipes:
+                    recipe.delete()
+                    counts['recipes_deleted'] += 1
+            for item_id, item in db_items.items():
+                if item_id not in items:
+                    item.delete()
+                    counts['items_deleted'] += 1
+
+    return counts
+
+
+def dataload():
+    return sync_data()
+
+
+if __name__ == '__main__':
+    import sys
+    print(sync_data(delete='--delete' in sys.argv))
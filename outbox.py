@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from telegram.error import TelegramError, RetryAfter, TimedOut, NetworkError, BadRequest
+
+import config
+
+logger = logging.getLogger("cw-crafts-bot")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        # seconds until a token is available, 0 when one can be taken now
+        if not self.rate:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        if self.rate:
+            self.tokens -= 1
+
+    @property
+    def full(self) -> bool:
+        self.delay(time.monotonic())
+        return not self.rate or self.tokens >= self.burst
+
+
+class _Job:
+    __slots__ = ('chat_id', 'fn', 'args', 'kwargs', 'key', 'attempts')
+
+    def __init__(self, chat_id, fn, args, kwargs, key=None):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.attempts = 0
+
+
+class Outbox:
+    """Sends Bot API calls from a few worker threads so handlers can return before Telegram answers.
+
+    Messages to a chat go out in order, within a global and a per-chat token bucket. A pending edit of a message
+    is replaced by a newer edit of the same message. A RetryAfter pauses the chat for as long as Telegram asks.
+    Until start() is called, calls are made straight away.
+    """
+
+    def __init__(self, workers: int, global_rate: float, chat_rate: float, chat_burst: float, group_rate: float,
+                 retries: int):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.retries = retries
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self.unchanged = 0
+        self._global = TokenBucket(global_rate, global_rate)
+        self._queues = OrderedDict()  # chat id -> deque of jobs, chats take turns in this order
+        self._edits = dict()  # (chat id, message id) -> edit job that has not been sent yet
+        self._buckets = dict()  # chat id -> TokenBucket
+        self._blocked = dict()  # chat id -> monotonic time until which Telegram asked us to wait
+        self._busy = set()  # chats a worker is sending to right now
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._threads = list()
+        self._running = False
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def stats(self) -> dict:
+        return {'pending': self._pending, 'sent': self.sent, 'coalesced': self.coalesced, 'retried': self.retried,
+                'failed': self.failed, 'unchanged': self.unchanged}
+
+    def start(self) -> None:
+        if self._running:
+            return
+        self._running = True
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'outbox-{n}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("outbox started with %d workers", self.workers)
+
+    def drain(self, timeout: float = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout: float = 10) -> None:
+        if not self._running:
+            return
+        if not self.drain(timeout):
+            logger.warning("outbox stopped with %d calls still queued", self._pending)
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def reply(self, msg, text: str, **kwargs) -> None:
+        self._enqueue(_Job(msg.chat_id, msg.reply_text, (text,), kwargs))
+
+    def edit(self, msg, text: str, **kwargs) -> None:
+        self._enqueue(_Job(msg.chat_id, msg.edit_text, (text,), kwargs, key=(msg.chat_id, msg.message_id)))
+
+    def answer(self, query, *args, **kwargs) -> None:
+        # callback and inline query answers are not messages, they skip the chat buckets
+        self._enqueue(_Job(None, query.answer, args, kwargs))
+
+    def _enqueue(self, job: _Job) -> None:
+        if not self._running:
+            job.fn(*job.args, **job.kwargs)
+            return
+        with self._cond:
+            pending = self._edits.get(job.key) if job.key else None
+            if pending is not None:
+                pending.fn, pending.args, pending.kwargs = job.fn, job.args, job.kwargs
+                self.coalesced += 1
+                return
+            if job.key:
+                self._edits[job.key] = job
+            self._queues.setdefault(job.chat_id, deque()).append(job)
+            self._pending += 1
+            self._cond.notify()
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._buckets = {c: b for c, b in self._buckets.items() if not b.full}
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _next(self):
+        # called with the condition held, returns a job to send or how long to wait for one
+        now = time.monotonic()
+        wait = None
+        for chat_id, jobs in self._queues.items():
+            if chat_id in self._busy:
+                continue
+            delay = self._blocked.get(chat_id, 0) - now
+            if chat_id is not None:
+                delay = max(delay, self._global.delay(now), self._bucket(chat_id).delay(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            job = jobs.popleft()
+            if jobs:
+                self._queues.move_to_end(chat_id)
+            else:
+                del self._queues[chat_id]
+            if job.key:
+                self._edits.pop(job.key, None)
+            if chat_id is not None:
+                self._global.take()
+                self._bucket(chat_id).take()
+                self._busy.add(chat_id)
+            self._blocked.pop(chat_id, None)
+            return job, None
+        return None, wait
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                job, wait = self._next()
+                while job is None:
+                    if not self._running:
+                        return
+                    self._cond.wait(wait)
+                    job, wait = self._next()
+            self._deliver(job)
+
+    def _deliver(self, job: _Job) -> None:
+        retry_in = None
+        try:
+            job.fn(*job.args, **job.kwargs)
+            self.sent += 1
+        except RetryAfter as e:
+            logger.warning("flood limit hit for chat %s, retrying in %ss", job.chat_id, e.retry_after)
+            retry_in = e.retry_after
+        except BadRequest as e:
+            if 'message is not modified' in e.message.lower():
+                # coalesced edits that ended where they started
+                self.unchanged += 1
+            else:
+                self.failed += 1
+                logger.warning("bad request for chat %s dropped: %s", job.chat_id, e)
+        except (TimedOut, NetworkError) as e:
+            job.attempts += 1
+            if job.attempts <= self.retries:
+                retry_in = 2 ** job.attempts
+                logger.info("network error for chat %s, retrying in %ss: %s", job.chat_id, retry_in, e)
+            else:
+                self.failed += 1
+                logger.warning("giving up on a call for chat %s after %d attempts: %s", job.chat_id, job.attempts, e)
+        except TelegramError as e:
+            self.failed += 1
+            logger.info("call for chat %s failed: %s", job.chat_id, e)
+        except Exception:
+            self.failed += 1
+            logger.exception("error sending to chat %s", job.chat_id)
+
+        with self._cond:
+            self._busy.discard(job.chat_id)
+            if retry_in is not None and job.key in self._edits:
+                # a newer edit of the same message was queued meanwhile, it replaces this one
+                self.coalesced += 1
+                self._pending -= 1
+            elif retry_in is not None:
+                self.retried += 1
+                self._blocked[job.chat_id] = time.monotonic() + retry_in
+                self._queues.setdefault(job.chat_id, deque()).appendleft(job)
+                if job.key:
+                    self._edits[job.key] = job
+            else:
+                self._pending -= 1
+            self._cond.notify_all()
+
+
+outbox = Outbox(config.OUTBOX_WORKERS, config.OUTBOX_GLOBAL_RATE, config.OUTBOX_CHAT_RATE, config.OUTBOX_CHAT_BURST,
+                config.OUTBOX_GROUP_RATE, config.OUTBOX_RETRIES)
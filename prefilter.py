@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from collections import Counter
+
+from telegram import Chat
+from telegram.ext import BaseFilter
+
+from graph import current_graph
+from search import tokenize
+
+import config
+
+
+class QueryFilter(BaseFilter):
+    """Lets through only text messages that could be an item search, before any handler work is done.
+
+    Messages that are too long or have too many words are dropped everywhere. In groups every word also has to
+    start an item name word, so chatter is not answered with "No items matched". The same text from the same
+    user in the same chat is dropped again for `debounce` seconds.
+    """
+
+    def __init__(self, max_length: int, max_words: int, debounce: float):
+        self.max_length = max_length
+        self.max_words = max_words
+        self.debounce = debounce
+        self.passed = 0
+        self.dropped = Counter()
+        self._recent = dict()  # (chat id, user id, text) -> monotonic time it was last let through
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        stats = {'passed': self.passed}
+        stats.update(('dropped_' + reason, n) for reason, n in self.dropped.items())
+        return stats
+
+    def _drop(self, reason: str) -> bool:
+        self.dropped[reason] += 1
+        return False
+
+    def filter(self, message) -> bool:
+        text = message.text
+        if not text:
+            return False
+        if message.chat.type == Chat.CHANNEL:
+            return self._drop('channel')
+        if len(text) > self.max_length:
+            return self._drop('too_long')
+        words = tokenize(text)
+        if not words:
+            return self._drop('no_words')
+        if len(words) > self.max_words:
+            return self._drop('too_many_words')
+        if message.chat.type != Chat.PRIVATE:
+            names = current_graph().names
+            if not all(names.has_prefix(word) for word in words):
+                return self._drop('not_an_item')
+
+        key = (message.chat_id, message.from_user.id if message.from_user else None, ' '.join(words))
+        now = time.monotonic()
+        with self._lock:
+            if now - self._recent.get(key, float('-inf')) < self.debounce:
+                return self._drop('repeated')
+            if len(self._recent) > 10000:
+                self._recent = {k: t for k, t in self._recent.items() if now - t < self.debounce}
+            self._recent[key] = now
+            self.passed += 1
+        return True
+
+
+query_filter = QueryFilter(config.QUERY_MAX_LENGTH, config.QUERY_MAX_WORDS, config.QUERY_DEBOUNCE)
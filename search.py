@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import re
+from bisect import bisect_left
+from collections import defaultdict
+
+token_re = re.compile(r"[\w']+")
+
+
+def tokenize(text: str) -> list:
+    return token_re.findall(text.lower())
+
+
+def normalize(name: str) -> str:
+    return ' '.join(name.lower().split())
+
+
+def trigrams(text: str) -> frozenset:
+    padded = '  {} '.format(' '.join(tokenize(text)))
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class NameIndex:
+    def __init__(self, items):
+        self.items = {i.id: i for i in items}
+        self._names = {i.id: i.name.lower() for i in items}
+        postings = defaultdict(set)
+        for i in items:
+            for token in tokenize(i.name):
+                postings[token].add(i.id)
+        self._postings = {k: frozenset(v) for k, v in postings.items()}
+        self._tokens = sorted(self._postings)
+
+        self._by_name = {normalize(i.name): i.id for i in items}
+        self._trigrams = {i.id: trigrams(i.name) for i in items}
+        grams = defaultdict(set)
+        for item_id, item_grams in self._trigrams.items():
+            for gram in item_grams:
+                grams[gram].add(item_id)
+        self._grams = {k: frozenset(v) for k, v in grams.items()}
+
+    def _prefixed(self, keyword: str) -> set:
+        ids = set()
+        pos = bisect_left(self._tokens, keyword)
+        while pos < len(self._tokens) and self._tokens[pos].startswith(keyword):
+            ids |= self._postings[self._tokens[pos]]
+            pos += 1
+        return ids
+
+    def has_prefix(self, keyword: str) -> bool:
+        # whether some item name has a word starting with keyword, keyword already lowercase
+        pos = bisect_left(self._tokens, keyword)
+        return pos < len(self._tokens) and self._tokens[pos].startswith(keyword)
+
+    def search(self, keywords) -> list:
+        keywords = [token for keyword in keywords for token in tokenize(keyword)]
+        if not keywords:
+            return list()
+
+        prefixed = None
+        for keyword in keywords:
+            prefixed = self._prefixed(keyword) if prefixed is None else prefixed & self._prefixed(keyword)
+            if not prefixed:
+                break
+
+        # the old "keyword anywhere in the name" matches, eg. "coal" in "Charcoal", come after word prefix matches
+        ids = {k for k, name in self._names.items() if all(kw in name for kw in keywords)} | prefixed
+
+        phrase = ' '.join(keywords)
+
+        def rank(item_id):
+            name = self._names[item_id]
+            whole_words = sum(1 for kw in keywords if item_id in self._postings.get(kw, ()))
+            return name != phrase, item_id not in prefixed, -whole_words, len(name), item_id
+
+        return [self.items[i] for i in sorted(ids, key=rank)]
+
+    def fuzzy(self, text: str, limit: int = 5, cutoff: float = 0.4) -> list:
+        # (item, score) by trigram Dice similarity, best first
+        query = trigrams(text)
+        if not query:
+            return list()
+        shared = defaultdict(int)
+        for gram in query:
+            for item_id in self._grams.get(gram, ()):
+                shared[item_id] += 1
+        scored = list()
+        for item_id, n in shared.items():
+            score = 2 * n / (len(query) + len(self._trigrams[item_id]))
+            if score >= cutoff:
+                scored.append((score, item_id))
+        scored.sort(key=lambda s: (-s[0], s[1]))
+        return [(self.items[item_id], round(score, 2)) for score, item_id in scored[:limit]]
+
+    def resolve(self, name: str):
+        # the item with exactly this name, ignoring case and spacing; recipes are written with it, so never guess
+        item_id = self._by_name.get(normalize(name))
+        return self.items[item_id] if item_id is not None else None
+
+    def did_you_mean(self, name: str, limit: int = 3) -> list:
+        # names of the closest items, to offer when resolve() finds nothing
+        return [item.name for item, score in self.fuzzy(name, limit)]
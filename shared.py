@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+import dbm
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from collections.abc import MutableMapping
+from uuid import uuid4
+
+logger = logging.getLogger("cw-crafts-bot")
+
+
+class LocalBackend:
+    """Keeps shared state in this process, for a single worker and for tests.
+
+    Values go through JSON like they do with Redis, so anything that works here works across workers.
+    """
+
+    def __init__(self):
+        self._data = dict()
+        self._expires = dict()
+        self._subscribers = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _live(self, key: str) -> bool:
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            return json.loads(self._data[key]) if self._live(key) else default
+
+    def set(self, key: str, value, ttl: float = None) -> None:
+        with self._lock:
+            self._data[key] = json.dumps(value)
+            if ttl:
+                self._expires[key] = time.monotonic() + ttl
+            else:
+                self._expires.pop(key, None)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    def keys(self, prefix: str) -> list:
+        with self._lock:
+            return [k for k in list(self._data) if k.startswith(prefix) and self._live(k)]
+
+    def publish(self, channel: str, message: dict) -> None:
+        payload = json.dumps(message)
+        for callback in list(self._subscribers[channel]):
+            try:
+                callback(json.loads(payload))
+            except Exception:
+                logger.exception("error handling a message on %s", channel)
+
+    def subscribe(self, channel: str, callback) -> None:
+        self._subscribers[channel].append(callback)
+
+
+class RedisBackend:
+    """Shares state between workers through Redis, needs the redis package."""
+
+    def __init__(self, url: str):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._pubsub = None
+        self._thread = None
+
+    def get(self, key: str, default=None):
+        value = self._redis.get(key)
+        return default if value is None else json.loads(value)
+
+    def set(self, key: str, value, ttl: float = None) -> None:
+        self._redis.set(key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, key: str) -> None:
+        self._redis.delete(key)
+
+    def keys(self, prefix: str) -> list:
+        return [k.decode('utf-8') for k in self._redis.scan_iter(match=prefix + '*')]
+
+    def publish(self, channel: str, message: dict) -> None:
+        self._redis.publish(channel, json.dumps(message))
+
+    def subscribe(self, channel: str, callback) -> None:
+        def handle(message):
+            try:
+                callback(json.loads(message['data']))
+            except Exception:
+                logger.exception("error handling a message on %s", channel)
+
+        if self._pubsub is None:
+            self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{channel: handle})
+        if self._thread is None:
+            self._thread = self._pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+class JournalStore(LocalBackend):
+    """A shared state backend that survives restarts of a single worker.
+
+    Writes are appended to `<path>.journal`. compact() folds the journal into the `<path>.db` dbm file and
+    truncates it. At start up only the journal is replayed, everything else is read from the dbm file the
+    first time it is asked for. Publish and subscribe stay in process.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.compactions = 0
+        self._db = dbm.open(path + '.db', 'c')
+        self._recent = dict()  # key -> (value json, expires) or None when deleted, since the last compaction
+        self._replay()
+        self._journal = open(path + '.journal', 'a', encoding='utf-8')
+
+    def _replay(self) -> None:
+        try:
+            with open(self.path + '.journal', 'r', encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        key, record = json.loads(line)
+                    except ValueError:
+                        logger.warning("skipping a torn line in the state journal")
+                        continue
+                    self._recent[key] = tuple(record) if record else None
+        except FileNotFoundError:
+            return
+        logger.info("replayed %d state changes from the journal", len(self._recent))
+
+    def _record(self, key: str):
+        if key in self._recent:
+            record = self._recent[key]
+        else:
+            raw = self._db.get(key.encode('utf-8'))
+            record = tuple(json.loads(raw)) if raw is not None else None
+        if record is not None and record[1] is not None and record[1] <= time.time():
+            return None
+        return record
+
+    def _write(self, key: str, record) -> None:
+        self._recent[key] = record
+        self._journal.write(json.dumps([key, record]) + '\n')
+        self._journal.flush()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            record = self._record(key)
+        return default if record is None else json.loads(record[0])
+
+    def set(self, key: str, value, ttl: float = None) -> None:
+        with self._lock:
+            self._write(key, (json.dumps(value), time.time() + ttl if ttl else None))
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if self._record(key) is not None:
+                self._write(key, None)
+
+    def keys(self, prefix: str) -> list:
+        with self._lock:
+            stored = {k.decode('utf-8') for k in self._db.keys()}
+            candidates = {k for k in stored | set(self._recent) if k.startswith(prefix)}
+            return sorted(k for k in candidates if self._record(k) is not None)
+
+    def compact(self) -> int:
+        with self._lock:
+            changes, self._recent = self._recent, dict()
+            now = time.time()
+            for key, record in changes.items():
+                if record is None or (record[1] is not None and record[1] <= now):
+                    if key.encode('utf-8') in self._db:
+                        del self._db[key.encode('utf-8')]
+                else:
+                    self._db[key.encode('utf-8')] = json.dumps(record)
+            if hasattr(self._db, 'sync'):
+                self._db.sync()
+            # replaying an old journal after a crash here only rewrites the same values
+            self._journal.close()
+            self._journal = open(self.path + '.journal', 'w', encoding='utf-8')
+        if changes:
+            self.compactions += 1
+            logger.debug("compacted %d state changes", len(changes))
+        return len(changes)
+
+    def close(self) -> None:
+        self.compact()
+        with self._lock:
+            self._journal.close()
+            self._db.close()
+
+
+class SharedConversations(MutableMapping):
+    """A ConversationHandler.conversations replacement that keeps the states in a backend.
+
+    Keys are the handler's (chat id, user id) style tuples, states must be JSON values. The handler looks its key
+    up on every update, so each worker reads from a local copy: changes are written to the backend, which only
+    seeds the copy at start up, and announced to the other workers on a channel.
+    """
+
+    def __init__(self, backend, name: str, ttl: float = None):
+        self.backend = backend
+        self.prefix = 'conv:{}:'.format(name)
+        self.ttl = ttl
+        self._origin = uuid4().hex
+        self._live = dict()  # key json -> (state, monotonic expiry or None)
+        self._lock = threading.Lock()
+        backend.subscribe(self.prefix, self._changed)
+        for key in backend.keys(self.prefix):
+            state = backend.get(key)
+            if state is not None:
+                self._keep(key[len(self.prefix):], state)
+
+    def _key(self, key) -> str:
+        return json.dumps(list(key))
+
+    def _keep(self, key: str, state) -> None:
+        with self._lock:
+            if state is None:
+                self._live.pop(key, None)
+            else:
+                self._live[key] = (state, time.monotonic() + self.ttl if self.ttl else None)
+
+    def _changed(self, message: dict) -> None:
+        if message['origin'] != self._origin:
+            self._keep(message['key'], message['state'])
+
+    def _write(self, key: str, state) -> None:
+        self._keep(key, state)
+        if state is None:
+            self.backend.delete(self.prefix + key)
+        else:
+            self.backend.set(self.prefix + key, state, self.ttl)
+        self.backend.publish(self.prefix, {'origin': self._origin, 'key': key, 'state': state})
+
+    def _get(self, key: str):
+        with self._lock:
+            entry = self._live.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                del self._live[key]
+                entry = None
+        return entry
+
+    def __getitem__(self, key):
+        entry = self._get(self._key(key))
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def __setitem__(self, key, state) -> None:
+        self._write(self._key(key), state)
+
+    def __delitem__(self, key) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._write(self._key(key), None)
+
+    def __iter__(self):
+        for key in list(self._live):
+            if self._get(key) is not None:
+                yield tuple(json.loads(key))
+
+    def __len__(self) -> int:
+        return sum(1 for key in self)
+
+
+class PersistentData(MutableMapping):
+    """Stands in for the dispatcher's user_data or chat_data, loading each id's dict on first use.
+
+    save() writes an id's dict back when it changed and forgets it, so only ids in use stay in memory and only
+    iterating goes over those. The dicts must be JSON values.
+    """
+
+    def __init__(self, backend, name: str):
+        self.backend = backend
+        self.name = name
+        self._loaded = dict()  # id -> dict handed out to handlers
+        self._saved = dict()  # id -> json of the dict as it was loaded
+
+    def _key(self, data_id) -> str:
+        return '{}:{}'.format(self.name, data_id)
+
+    def __getitem__(self, data_id) -> dict:
+        data = self._loaded.get(data_id)
+        if data is None:
+            data = self.backend.get(self._key(data_id)) or dict()
+            self._loaded[data_id] = data
+            self._saved[data_id] = json.dumps(data, sort_keys=True)
+        return data
+
+    def __setitem__(self, data_id, data: dict) -> None:
+        self[data_id]
+        self._loaded[data_id] = data
+
+    def __delitem__(self, data_id) -> None:
+        self._loaded.pop(data_id, None)
+        self._saved.pop(data_id, None)
+        self.backend.delete(self._key(data_id))
+
+    def __iter__(self):
+        return iter(list(self._loaded))
+
+    def __len__(self) -> int:
+        return len(self._loaded)
+
+    def save(self, data_id) -> bool:
+        if data_id not in self._loaded:
+            return False
+        data = self._loaded.pop(data_id)
+        saved = self._saved.pop(data_id)
+        current = json.dumps(data, sort_keys=True)
+        if current == saved:
+            return False
+        if data:
+            self.backend.set(self._key(data_id), data)
+        else:
+            self.backend.delete(self._key(data_id))
+        return True
+
+
+def on_volume(path: str) -> bool:
+    # whether path is on a mounted volume rather than a container's own filesystem, which a redeploy throws away
+    if 'DYNO' in os.environ:
+        return False  # Heroku has no volumes
+    directory = os.path.dirname(os.path.abspath(path))
+    while not os.path.ismount(directory):
+        directory = os.path.dirname(directory)
+    return directory != '/'
+
+
+def make_backend(url: str = None, path: str = None):
+    if url:
+        logger.info("sharing state between workers through %s", url.split('@')[-1])
+        return RedisBackend(url)
+    if path:
+        return JournalStore(path)
+    return LocalBackend()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+from graph import RecipeGraph, GraphItem, Edge, Shape
+
+logger = logging.getLogger("cw-crafts-bot")
+
+# Layout, all integers little-endian u32 unless noted:
+#   header       magic, version (u16), reserved (u16), items, edges, strings, string bytes
+#   str_offsets  strings + 1 offsets into the string blob
+#   item_ids     string index of each item id, items sorted by id
+#   item_names   string index of each item name
+#   row_ptr      items + 1 offsets into the edge arrays, edges of item n are row_ptr[n]:row_ptr[n + 1]
+#   ingredients  item index of each edge's ingredient, edges sorted by result then recipe id
+#   quantities
+#   recipe_ids
+#   depth        RecipeGraph.shape depth of each item, UNKNOWN for items on or above a recipe cycle
+#   tree_size    RecipeGraph.shape size of each item, UNKNOWN likewise
+#   complex      one byte per item
+#   strings      utf-8 blob
+#   crc32        of everything above
+MAGIC = b'CWCS'
+VERSION = 2
+UNKNOWN = 0xFFFFFFFF
+_header = struct.Struct('<4sHHIIII')
+
+
+def dump_snapshot(graph: RecipeGraph, path: str) -> None:
+    items = sorted(graph.items.values(), key=lambda i: i.id)
+    index = {item.id: n for n, item in enumerate(items)}
+
+    blob = bytearray()
+    interned = dict()
+    str_offsets = array('I', [0])
+
+    def intern(text):
+        if text not in interned:
+            interned[text] = len(str_offsets) - 1
+            blob.extend(text.encode('utf-8'))
+            str_offsets.append(len(blob))
+        return interned[text]
+
+    item_ids = array('I', (intern(i.id) for i in items))
+    item_names = array('I', (intern(i.name) for i in items))
+    complex_flags = bytes(int(i.complex) for i in items)
+
+    row_ptr = array('I', [0])
+    ingredients, quantities, recipe_ids = array('I'), array('I'), array('I')
+    for item in items:
+        for e in graph.result_of.get(item.id, ()):
+            ingredients.append(index[e.ingredient])
+            quantities.append(e.qty)
+            recipe_ids.append(e.recipe_id)
+        row_ptr.append(len(ingredients))
+
+    shape = graph.shape
+    depth = array('I', (shape.depth.get(i.id, UNKNOWN) for i in items))
+    tree_size = array('I', (min(shape.size[i.id], UNKNOWN - 1) if i.id in shape.size else UNKNOWN for i in items))
+
+    body = bytearray(_header.pack(MAGIC, VERSION, 0, len(items), len(ingredients), len(interned), len(blob)))
+    for section in (str_offsets, item_ids, item_names, row_ptr, ingredients, quantities, recipe_ids, depth,
+                    tree_size):
+        if sys.byteorder != 'little':
+            section.byteswap()
+        body += section.tobytes()
+    body += complex_flags
+    body += blob
+    body += struct.pack('<I', zlib.crc32(body))
+
+    # write next to the target and rename, so a running bot never maps a half written file
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(body)
+    os.replace(tmp_path, path)
+    logger.info("recipe snapshot written to %s: %d items, %d recipe parts, %d bytes",
+                path, len(items), len(ingredients), len(body))
+
+
+def load_snapshot(path: str) -> RecipeGraph:
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            if len(view) < _header.size + 4:
+                raise ValueError(f"{path} is too short to be a recipe snapshot")
+            magic, version, _, n_items, n_edges, n_strings, n_bytes = _header.unpack_from(view)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a version {VERSION} recipe snapshot")
+            if struct.unpack_from('<I', view, len(view) - 4)[0] != zlib.crc32(view[:-4]):
+                raise ValueError(f"{path} is corrupt")
+
+            pos = _header.size
+
+            def u32s(count):
+                nonlocal pos
+                section = array('I')
+                section.frombytes(view[pos:pos + 4 * count])
+                if sys.byteorder != 'little':
+                    section.byteswap()
+                pos += 4 * count
+                return section
+
+            str_offsets = u32s(n_strings + 1)
+            item_ids = u32s(n_items)
+            item_names = u32s(n_items)
+            row_ptr = u32s(n_items + 1)
+            ingredients = u32s(n_edges)
+            quantities = u32s(n_edges)
+            recipe_ids = u32s(n_edges)
+            depth = u32s(n_items)
+            tree_size = u32s(n_items)
+            complex_flags = bytes(view[pos:pos + n_items])
+            pos += n_items
+            blob = bytes(view[pos:pos + n_bytes])
+            strings = [blob[str_offsets[n]:str_offsets[n + 1]].decode('utf-8') for n in range(n_strings)]
+
+            ids = [strings[n] for n in item_ids]
+            items = [GraphItem(ids[n], strings[item_names[n]], bool(complex_flags[n])) for n in range(n_items)]
+            edges = [Edge(recipe_ids[e], ids[n], ids[ingredients[e]], quantities[e])
+                     for n in range(n_items) for e in range(row_ptr[n], row_ptr[n + 1])]
+            depths = {ids[n]: depth[n] for n in range(n_items) if depth[n] != UNKNOWN}
+            sizes = {ids[n]: tree_size[n] for n in range(n_items) if tree_size[n] != UNKNOWN}
+        finally:
+            view.release()
+    graph = RecipeGraph(items, edges)
+    graph.shape = Shape(tuple(sorted(depths, key=lambda i: (depths[i], i))), depths, sizes)
+    return graph
+
+
+def compile_snapshot(path: str, data_path: str = 'data.json', use_db: bool = True) -> RecipeGraph:
+    # data.json plus whatever the database knows, database rows win where both have a recipe part
+    with open(data_path, 'r') as fp:
+        data = json.load(fp)
+
+    items = {i["id"]: GraphItem(i["id"], i["name"], i.get("complex", False)) for i in data["items"]}
+    edges = dict()
+    if use_db:
+        from graph import load_graph
+        graph = load_graph()
+        items.update(graph.items)
+        edges = {(e.result, e.ingredient): e for e in graph.edges}
+
+    next_id = max((e.recipe_id for e in edges.values()), default=0) + 1
+    for recipe in data["recipes"]:
+        for qty, ingr in recipe["ingredients"]:
+            if (recipe["id"], ingr) not in edges:
+                edges[(recipe["id"], ingr)] = Edge(next_id, recipe["id"], ingr, qty)
+                next_id += 1
+
+    graph = RecipeGraph(items.values(), edges.values())
+    graph.check()
+    dump_snapshot(graph, path)
+    return graph
+
+
+if __name__ == '__main__':
+    import config
+    logging.basicConfig(level=logging.INFO)
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    compile_snapshot(args[0] if args else config.SNAPSHOT_PATH, use_db='--no-db' not in sys.argv)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import heapq
+import sys
+from array import array
+from collections import defaultdict
+from datetime import datetime, timezone
+from itertools import chain
+
+from pony import orm
+
+from models import Stock, StockHistory
+
+import config
+
+# StockHistory.records is a run of records, all integers little-endian i32:
+#   minute   minutes since the epoch the /more was forwarded at
+#   changes  number of pairs that follow
+#   pairs    (slot, change): index into StockHistory.slots and the quantity gained, negative when it went down
+# The first record holds the whole stock, so an item's changes up to a record add up to its quantity at that
+# time. Once a user has more than config.STOCK_HISTORY_LIMIT records the first two are merged.
+
+
+def _load(data: bytes) -> array:
+    values = array('i')
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _dump(values: array) -> bytes:
+    if sys.byteorder != 'little':
+        values = array('i', values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _records(values: array):
+    # (minute, offset of the first pair, pairs) of each record, without copying any out
+    pos = 0
+    while pos < len(values):
+        yield values[pos], pos + 2, values[pos + 1]
+        pos += 2 + 2 * values[pos + 1]
+
+
+def _minute(when: datetime) -> int:
+    return int(when.replace(tzinfo=timezone.utc).timestamp()) // 60
+
+
+def _time(minute: int) -> datetime:
+    return datetime.utcfromtimestamp(minute * 60)
+
+
+def _merge_first(values: array) -> array:
+    records = _records(values)
+    _, first, n = next(records)
+    minute, second, m = next(records)
+    totals = defaultdict(int)
+    for pos in chain(range(first, first + 2 * n, 2), range(second, second + 2 * m, 2)):
+        totals[values[pos]] += values[pos + 1]
+    totals = [(slot, qty) for slot, qty in sorted(totals.items()) if qty]
+    merged = array('i', [minute, len(totals)])
+    for pair in totals:
+        merged.extend(pair)
+    return merged + values[second + 2 * m:]
+
+
+def record_stock(user, stock: dict, previous: dict, when: datetime) -> bool:
+    # append a forwarded /more to the user's history, previous is the stock it replaces, needs a db_session
+    history = user.stock_history
+    if history is None:
+        previous = dict()
+    changes = {k: stock.get(k, 0) - previous.get(k, 0) for k in stock.keys() | previous.keys()}
+    changes = {k: v for k, v in changes.items() if v}
+    if history is not None and not changes:
+        return False
+
+    slots = list(history.slots) if history else list()
+    index = {item_id: n for n, item_id in enumerate(slots)}
+    record = array('i', [_minute(when), len(changes)])
+    for item_id, change in sorted(changes.items()):
+        if item_id not in index:
+            index[item_id] = len(slots)
+            slots.append(item_id)
+        record.extend((index[item_id], change))
+
+    if history is None:
+        StockHistory(user=user, slots=slots, records=_dump(record), snapshots=1, updated=when)
+        return True
+    values = _load(history.records) + record
+    snapshots = history.snapshots + 1
+    if snapshots > config.STOCK_HISTORY_LIMIT:
+        values = _merge_first(values)
+        snapshots -= 1
+    history.set(slots=slots, records=_dump(values), snapshots=snapshots, updated=when)
+    return True
+
+
+def _item_changes(slots: list, data: bytes, item_id: str):
+    # (minute, change) of one item, oldest first
+    if item_id not in slots:
+        return
+    slot = slots.index(item_id)
+    values = _load(data)
+    for minute, pos, n in _records(values):
+        for p in range(pos, pos + 2 * n, 2):
+            if values[p] == slot:
+                yield minute, values[p + 1]
+                break
+
+
+def recent_changes(user_id: int, limit: int) -> list:
+    # [(time, {item id: change})] of the user's last few snapshots, newest first
+    with orm.db_session:
+        history = StockHistory.get(user=user_id)
+        if history is None:
+            return list()
+        slots, values = history.slots, _load(history.records)
+    changes = list()
+    for minute, pos, n in list(_records(values))[-limit:]:
+        changes.append((_time(minute), {slots[values[p]]: values[p + 1] for p in range(pos, pos + 2 * n, 2)}))
+    return changes[::-1]
+
+
+def trend(user_ids, item_id: str) -> list:
+    # [(time, quantity)] of an item added up over the users, at every snapshot where it changed, oldest first
+    with orm.db_session:
+        rows = orm.select((h.slots, h.records) for h in StockHistory if h.user.id in user_ids)[:]
+    points = list()
+    total = 0
+    for minute, change in heapq.merge(*(_item_changes(slots, data, item_id) for slots, data in rows)):
+        total += change
+        if points and points[-1][0] == minute:
+            points[-1] = (minute, total)
+        else:
+            points.append((minute, total))
+    return [(_time(minute), qty) for minute, qty in points]
+
+
+def totals(user_ids) -> dict:
+    # item id -> quantity the users hold together, as of their last forwarded /more
+    result = defaultdict(int)
+    with orm.db_session:
+        for items in orm.select(s.items for s in Stock if s.user.id in user_ids):
+            for item_id, qty in items.items():
+                result[item_id] += qty
+    return dict(result)
+
+
+def top_holders(user_ids, item_id: str, limit: int) -> list:
+    # [(first name, quantity)] of the users holding the most of an item
+    with orm.db_session:
+        rows = orm.select((s.user.first_name, s.items) for s in Stock if s.user.id in user_ids)[:]
+    holders = [(name, items[item_id]) for name, items in rows if items.get(item_id)]
+    return sorted(holders, key=lambda h: -h[1])[:limit]
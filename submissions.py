@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import logging
+from collections import namedtuple
+
+from pony import orm
+
+from consts import recipe_re, recipe_parts_re, tavern_hint_re
+from graph import Edge, current_graph
+from models import Recipe
+
+logger = logging.getLogger("cw-crafts-bot")
+
+# parts: [(ingredient name, qty)], a tavern hint is a submission with a single part
+Submission = namedtuple('Submission', ['name', 'parts'])
+# suggestions: names of close items when a name is not in the database
+Outcome = namedtuple('Outcome', ['name', 'status', 'detail', 'suggestions'], defaults=[()])
+
+
+def parse_submissions(text: str) -> list:
+    # every recipe and tavern hint in a forward or in a message with several of them pasted together
+    submissions = list()
+    headers = list(recipe_re.finditer(text))
+    for n, header in enumerate(headers):
+        end = headers[n + 1].start() if n + 1 < len(headers) else len(text)
+        parts = [(name, int(qty)) for name, qty in recipe_parts_re.findall(text, header.end(), end)]
+        if parts:
+            submissions.append(Submission(header.group('name'), parts))
+    for hint in tavern_hint_re.finditer(text):
+        submissions.append(Submission(hint.group('name'), [(hint.group('item'), int(hint.group('qty')))]))
+    return submissions
+
+
+def import_submissions(submissions) -> tuple:
+    """Resolve, check and store recipe submissions, returning an Outcome for each and the Edges added.
+
+    Names must match an item exactly, ignoring case and spacing, close names are only suggested. Only complex
+    items take recipes. Parts the graph or the database already know are skipped, and a submission that would
+    create a recipe cycle, with the graph or with earlier submissions, is refused. All new parts are written in
+    one transaction; if that fails every submission that was going to add parts is reported as 'failed' and
+    nothing is written.
+    """
+    graph = current_graph()
+    names = graph.names
+    outcomes = list()
+    accepted = list()  # (outcome index, result item, [(ingredient item, qty)])
+    pairs = list()
+
+    for submission in submissions:
+        result = names.resolve(submission.name)
+        if result is None:
+            suggestions = names.did_you_mean(submission.name)
+            outcomes.append(Outcome(submission.name, 'unknown', submission.name, suggestions))
+            continue
+        if not result.complex:
+            outcomes.append(Outcome(result.name, 'basic', None))
+            continue
+
+        ingredients = list()
+        for name, qty in submission.parts:
+            ingredient = names.resolve(name)
+            if ingredient is None:
+                outcomes.append(Outcome(result.name, 'unknown', name, names.did_you_mean(name)))
+                break
+            ingredients.append((ingredient, qty))
+        else:
+            known = {e.ingredient for e in graph.result_of.get(result.id, ())}
+            known |= {ingredient for r, ingredient in pairs if r == result.id}
+            new = dict()  # an ingredient listed twice is only added once
+            for i, qty in ingredients:
+                if i.id not in known:
+                    new.setdefault(i.id, (i, qty))
+            ingredients = list(new.values())
+            new_pairs = [(result.id, i.id) for i, qty in ingredients]
+            if not ingredients:
+                outcomes.append(Outcome(result.name, 'known', None))
+            elif graph.cycle_with(pairs + new_pairs):
+                outcomes.append(Outcome(result.name, 'cycle', None))
+            else:
+                pairs.extend(new_pairs)
+                accepted.append((len(outcomes), result, ingredients))
+                outcomes.append(Outcome(result.name, 'added', len(ingredients)))
+
+    edges = list()
+    if accepted:
+        try:
+            with orm.db_session:
+                # another worker may have stored some of these parts since our graph was built
+                result_ids = [result.id for n, result, ingredients in accepted]
+                stored = orm.select(r for r in Recipe if r.result_item.id in result_ids)
+                stored = {(r.result_item.id, r.ingredient_item.id): r for r in stored}
+                edges = [Edge(r.id, r.result_item.id, r.ingredient_item.id, r.quantity_req)
+                         for key, r in stored.items() if key in set(pairs)]
+                rows = list()
+                for n, result, ingredients in accepted:
+                    ingredients = [(i, qty) for i, qty in ingredients if (result.id, i.id) not in stored]
+                    rows.extend(Recipe(result_item=result.id, ingredient_item=i.id, quantity_req=qty)
+                                for i, qty in ingredients)
+                    outcomes[n] = Outcome(result.name, 'added', len(ingredients)) if ingredients else \
+                        Outcome(result.name, 'known', None)
+                orm.commit()
+                edges += [Edge(row.id, row.result_item.id, row.ingredient_item.id, row.quantity_req) for row in rows]
+        except orm.TransactionIntegrityError:
+            logger.exception("failed to import %d submissions", len(submissions))
+            for n, result, ingredients in accepted:
+                outcomes[n] = Outcome(result.name, 'failed', None)
+            return outcomes, list()
+        logger.info("imported %d recipe parts from %d submissions", len(rows), len(submissions))
+    return outcomes, edges
+
+
+def did_you_mean(suggestions) -> str:
+    return ' Did you mean {}?'.format(' or '.join('<b>{}</b>'.format(s) for s in suggestions)) if suggestions else ''
+
+
+def describe(outcome: Outcome) -> str:
+    if outcome.status == 'added':
+        return "Added {} part{} to the recipe for <b>{}</b>.".format(
+            outcome.detail, '' if outcome.detail == 1 else 's', outcome.name)
+    if outcome.status == 'known':
+        return "I already know the recipe for <b>{}</b>.".format(outcome.name)
+    if outcome.status == 'failed':
+        return "Could not save the recipe for <b>{}</b>, nothing was added.".format(outcome.name)
+    if outcome.status == 'basic':
+        return "<b>{}</b> is not crafted, so it cannot have a recipe.".format(outcome.name)
+    if outcome.status == 'cycle':
+        return "That would make <b>{}</b> part of its own recipe.".format(outcome.name)
+    if outcome.name == outcome.detail:
+        return "<b>{}</b> is not in my database.".format(outcome.name) + did_you_mean(outcome.suggestions)
+    return "Unable to find <b>{}</b> from the recipe for <b>{}</b> in my database.".format(
+        outcome.detail, outcome.name) + did_you_mean(outcome.suggestions)
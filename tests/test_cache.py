@@ -0,0 +1,73 @@
+import graph
+from cache import RenderCache
+from graph import RecipeGraph
+
+
+def test_get_put_and_counters():
+    cache = RenderCache(10, 60)
+    assert cache.get('a01', 'craft') is None
+    cache.put('a01', 'craft', 'text')
+    assert cache.get('a01', 'craft') == 'text'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_invalidate_drops_every_kind_of_the_given_items_only():
+    cache = RenderCache(10, 60)
+    cache.put('a01', 'craft', 'a')
+    cache.put('a01', ('tree', 1, ()), 'b')
+    cache.put('a02', 'craft', 'c')
+    cache.invalidate(['a01', 'missing'])
+    assert cache.get('a01', 'craft') is None
+    assert cache.get('a01', ('tree', 1, ())) is None
+    assert cache.get('a02', 'craft') == 'c'
+    assert cache.stats()['invalidations'] == 2
+    assert len(cache) == 1
+
+
+def test_least_recently_used_is_evicted():
+    cache = RenderCache(2, 60)
+    cache.put('a', 'craft', 'a')
+    cache.put('b', 'craft', 'b')
+    cache.get('a', 'craft')
+    cache.put('c', 'craft', 'c')
+    assert cache.get('b', 'craft') is None
+    assert cache.get('a', 'craft') == 'a'
+    assert cache.stats()['evictions'] == 1
+    # an evicted entry must not leave its key behind for invalidate
+    cache.invalidate(['b'])
+    assert cache.stats()['invalidations'] == 0
+
+
+def test_expired_entries_are_misses():
+    cache = RenderCache(10, -1)
+    cache.put('a', 'craft', 'a')
+    assert cache.get('a', 'craft') is None
+    assert len(cache) == 0
+    assert cache.stats()['evictions'] == 1
+
+
+def test_clear():
+    cache = RenderCache(10, 60)
+    cache.put('a', 'craft', 'a')
+    cache.put('b', 'craft', 'b')
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.stats()['invalidations'] == 2
+    cache.put('a', 'craft', 'a2')
+    assert cache.get('a', 'craft') == 'a2'
+
+
+def test_text_rendered_from_a_replaced_graph_is_not_kept():
+    previous = graph.current_graph()
+    try:
+        old = graph.install_graph(RecipeGraph((), ()))
+        graph.install_graph(RecipeGraph((), ()))
+        cache = RenderCache(10, 60)
+        cache.put('a', 'craft', 'stale', old)
+        assert cache.get('a', 'craft') is None
+        assert cache.stats()['stale'] == 1
+        cache.put('a', 'craft', 'fresh', graph.current_graph())
+        assert cache.get('a', 'craft') == 'fresh'
+    finally:
+        graph._swap(previous)
@@ -0,0 +1,85 @@
+import pytest
+
+import graph
+from graph import GraphItem, Edge, RecipeGraph, RecipeCycleError, find_cycle
+
+# sword <- 2 x blade, 1 x thread; blade <- 3 x steel; steel and thread are basic
+ITEMS = [GraphItem('s', 'Sword', True), GraphItem('b', 'Blade', True), GraphItem('st', 'Steel', False),
+         GraphItem('t', 'Thread', False)]
+EDGES = [Edge(1, 's', 'b', 2), Edge(2, 's', 't', 1), Edge(3, 'b', 'st', 3)]
+
+
+@pytest.fixture
+def installed():
+    previous = graph.current_graph()
+    yield
+    graph._swap(previous)
+
+
+def test_find_cycle():
+    assert find_cycle({'a': {'b'}, 'b': {'c'}}) is None
+    assert find_cycle({'a': {'b'}, 'b': {'a'}}) == ['a', 'b', 'a']
+    assert find_cycle({'a': {'a'}}) == ['a', 'a']
+    cycle = find_cycle({'x': {'a'}, 'a': {'b'}, 'b': {'c'}, 'c': {'a'}})
+    assert cycle[0] == cycle[-1] and set(cycle) == {'a', 'b', 'c'}
+
+
+def test_shape():
+    g = RecipeGraph(ITEMS, EDGES)
+    assert g.shape.depth == {'st': 0, 't': 0, 'b': 1, 's': 2}
+    # a blade is one line, a sword is the blade with its steel plus the thread
+    assert g.shape.size == {'st': 0, 't': 0, 'b': 1, 's': 3}
+    assert g.shape.order == ('st', 't', 'b', 's')
+    assert g.cycle is None
+    g.check()
+
+
+def test_shape_leaves_out_cycles_and_what_is_above_them():
+    g = RecipeGraph(ITEMS, EDGES + [Edge(4, 'st', 's', 1)])
+    assert set(g.shape.depth) == {'t'}
+    assert g.cycle == ['b', 'st', 's', 'b']
+    with pytest.raises(RecipeCycleError) as error:
+        g.check()
+    assert error.value.cycle == g.cycle
+
+
+def test_cycle_with():
+    g = RecipeGraph(ITEMS, EDGES)
+    assert g.cycle_with([('t', 'st')]) is None
+    assert g.cycle_with([('st', 's')]) is not None
+    assert g.cycle_with([('t', 'b'), ('st', 't')]) is not None
+
+
+def test_bill_of_materials_and_missing():
+    g = RecipeGraph(ITEMS, EDGES)
+    assert g.bill_of_materials('s', 2) == (('st', 12), ('t', 2))
+    assert g.missing('s', {'b': 1, 'st': 1}) == (('st', 2), ('t', 1))
+    assert g.craftable({'st': 7, 'b': 2, 't': 1}) == {'b': 2, 's': 1}
+
+
+def test_only_complex_ingredients_are_broken_down():
+    # ore has a recipe but is not complex, the craft tree shows it as it is and so must the totals
+    items = [GraphItem('s', 'Sword', True), GraphItem('o', 'Ore', False), GraphItem('t', 'Thread', False)]
+    g = RecipeGraph(items, [Edge(1, 's', 'o', 2), Edge(2, 'o', 't', 3)])
+    assert g.shape.size['s'] == 1
+    assert g.bill_of_materials('s') == (('o', 2),)
+    assert g.bill_of_materials('o', 2) == (('t', 6),)
+    assert g.missing('s', {}) == (('o', 2),)
+
+
+def test_add_edges_skips_known_recipes(installed):
+    graph.install_graph(RecipeGraph(ITEMS, EDGES[:2]))
+    g = graph.add_edges([EDGES[2], EDGES[0]])
+    assert g is graph.current_graph()
+    assert len(g.edges) == 3
+    assert graph.add_edges([EDGES[2]]) is g
+
+
+def test_install_keeps_edges_added_while_loading(installed):
+    graph.install_graph(RecipeGraph(ITEMS, EDGES[:2]))
+    graph._loading = list()
+    graph.add_edges([EDGES[2]])
+    # a graph read from the tables before EDGES[2] was committed
+    g = graph.install_graph(RecipeGraph(ITEMS, EDGES[:2]))
+    assert EDGES[2] in g.edges
+    assert graph._loading is None
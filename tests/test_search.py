@@ -0,0 +1,23 @@
+from graph import GraphItem
+from search import NameIndex
+
+ITEMS = [GraphItem('01', 'Coal', False), GraphItem('02', 'Charcoal', False), GraphItem('03', 'Hunter Gloves', True),
+         GraphItem('04', 'Champion Sword', True), GraphItem('05', 'Order Armor', True)]
+
+
+def names(found) -> list:
+    return [item.name for item in found]
+
+
+def test_substring_matches_follow_prefix_matches():
+    index = NameIndex(ITEMS)
+    assert names(index.search(['coal'])) == ['Coal', 'Charcoal']
+    assert names(index.search(['love'])) == ['Hunter Gloves']
+    assert names(index.search(['ord'])) == ['Order Armor', 'Champion Sword']
+
+
+def test_resolve_only_takes_exact_names():
+    index = NameIndex(ITEMS)
+    assert index.resolve('  champion   SWORD ').id == '04'
+    assert index.resolve('Champion Swor') is None
+    assert 'Champion Sword' in index.did_you_mean('Champion Swor')
@@ -0,0 +1,193 @@
+import pytest
+
+import shared
+from shared import LocalBackend, JournalStore, SharedConversations, PersistentData
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(shared.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(shared.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = JournalStore(str(tmp_path / 'state'))
+    yield store
+    store.close()
+
+
+def crash(store: JournalStore) -> None:
+    # drop the store without compacting, like a killed worker would
+    store._journal.close()
+    store._db.close()
+
+
+def test_local_values_go_through_json():
+    backend = LocalBackend()
+    backend.set('k', {'a': (1, 2)})
+    assert backend.get('k') == {'a': [1, 2]}
+    assert backend.get('missing', 'default') == 'default'
+    backend.delete('k')
+    assert backend.get('k') is None
+
+
+def test_local_ttl_and_keys(clock):
+    backend = LocalBackend()
+    backend.set('conv:a:1', 1, ttl=10)
+    backend.set('conv:a:2', 2)
+    backend.set('conv:b:1', 3)
+    assert sorted(backend.keys('conv:a:')) == ['conv:a:1', 'conv:a:2']
+    clock[0] += 10
+    assert backend.get('conv:a:1') is None
+    assert backend.keys('conv:a:') == ['conv:a:2']
+
+
+def test_local_publish_survives_a_failing_subscriber():
+    backend = LocalBackend()
+    received = list()
+    backend.subscribe('recipes', lambda message: 1 / 0)
+    backend.subscribe('recipes', received.append)
+    backend.publish('recipes', {'edges': [(1, 'a', 'b', 2)]})
+    assert received == [{'edges': [[1, 'a', 'b', 2]]}]
+
+
+def test_journal_replays_after_a_crash(tmp_path):
+    path = str(tmp_path / 'state')
+    store = JournalStore(path)
+    store.set('user:1', {'batch': []})
+    store.set('user:2', 'gone')
+    store.delete('user:2')
+    crash(store)
+
+    store = JournalStore(path)
+    assert store.get('user:1') == {'batch': []}
+    assert store.get('user:2') is None
+    assert store.keys('user:') == ['user:1']
+    store.close()
+
+
+def test_journal_skips_a_torn_line(tmp_path):
+    path = str(tmp_path / 'state')
+    store = JournalStore(path)
+    store.set('a', 1)
+    crash(store)
+    with open(path + '.journal', 'a', encoding='utf-8') as fp:
+        fp.write('["b", ["2"')
+
+    store = JournalStore(path)
+    assert store.get('a') == 1
+    assert store.get('b') is None
+    store.close()
+
+
+def test_compact_moves_the_journal_into_the_db(tmp_path):
+    path = str(tmp_path / 'state')
+    store = JournalStore(path)
+    store.set('a', 1)
+    store.set('b', 2)
+    assert store.compact() == 2
+    assert open(path + '.journal', encoding='utf-8').read() == ''
+    store.delete('b')
+    store.close()
+
+    store = JournalStore(path)
+    assert store._recent == {}
+    assert store.get('a') == 1
+    assert store.get('b') is None
+    assert store.keys('') == ['a']
+    store.close()
+
+
+def test_journal_ttl_uses_wall_clock(store, clock):
+    store.set('conv:x', 1, ttl=5)
+    store.compact()
+    assert store.get('conv:x') == 1
+    clock[0] += 5
+    assert store.get('conv:x') is None
+    assert store.keys('conv:') == []
+
+
+def test_shared_conversations_keys_are_tuples():
+    conversations = SharedConversations(LocalBackend(), 'submit')
+    conversations[(1, 2)] = 0
+    assert (1, 2) in conversations
+    assert conversations[(1, 2)] == 0
+    assert list(conversations) == [(1, 2)]
+    assert len(conversations) == 1
+    del conversations[(1, 2)]
+    assert (1, 2) not in conversations
+    with pytest.raises(KeyError):
+        conversations[(1, 2)]
+    with pytest.raises(KeyError):
+        del conversations[(1, 2)]
+
+
+def test_shared_conversations_expire(clock):
+    conversations = SharedConversations(LocalBackend(), 'batch', ttl=60)
+    conversations[(1, 1)] = 0
+    clock[0] += 60
+    assert (1, 1) not in conversations
+
+
+def test_shared_conversations_are_read_locally_and_shared_between_workers():
+    backend = LocalBackend()
+    first = SharedConversations(backend, 'submit')
+    second = SharedConversations(backend, 'submit')
+    reads = list()
+    get = backend.get
+    backend.get = lambda key, default=None: reads.append(key) or get(key, default)
+
+    first[(1, 1)] = 0
+    assert second[(1, 1)] == 0
+    assert (2, 2) not in second
+    assert reads == []
+
+    # a worker started later picks up the live conversations from the backend
+    third = SharedConversations(backend, 'submit')
+    assert third[(1, 1)] == 0
+
+    del second[(1, 1)]
+    assert (1, 1) not in first
+    assert (1, 1) not in third
+    assert backend.keys('conv:submit:') == []
+
+
+def test_persistent_data_only_writes_changes():
+    backend = LocalBackend()
+    writes = list()
+    set_value = backend.set
+    backend.set = lambda key, value, ttl=None: writes.append(key) or set_value(key, value, ttl)
+    data = PersistentData(backend, 'user')
+
+    data[1]['batch'] = [['Sword', [['Steel', 1]]]]
+    assert data.save(1)
+    assert not data.save(1)  # forgotten once saved
+    assert list(data) == []
+
+    assert data[1] == {'batch': [['Sword', [['Steel', 1]]]]}
+    assert not data.save(1)
+    assert writes == ['user:1']
+
+    data[1].clear()
+    assert data.save(1)
+    assert backend.get('user:1') is None
+
+
+def test_make_backend_prefers_redis_then_journal(tmp_path):
+    assert type(shared.make_backend()) is LocalBackend
+    store = shared.make_backend(None, str(tmp_path / 'state'))
+    assert isinstance(store, JournalStore)
+    store.close()
+
+
+def test_on_volume(monkeypatch):
+    monkeypatch.delenv('DYNO', raising=False)
+    mounts = {'/', '/data'}
+    monkeypatch.setattr(shared.os.path, 'ismount', lambda path: path in mounts)
+    assert shared.on_volume('/data/state/state')
+    assert not shared.on_volume('/usr/src/app/state')
+    monkeypatch.setenv('DYNO', 'web.1')
+    assert not shared.on_volume('/data/state/state')
@@ -0,0 +1,97 @@
+import struct
+from array import array
+from datetime import datetime, timedelta
+
+import pytest
+
+import stockhistory
+from stockhistory import record_stock, _load, _dump, _records, _merge_first, _item_changes
+
+START = datetime(2026, 10, 18, 12, 0)
+
+
+class History:
+    # stands in for a StockHistory row
+    def __init__(self):
+        self.slots = list()
+        self.records = b''
+        self.snapshots = 0
+        self.updated = None
+
+    def set(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class User:
+    def __init__(self):
+        self.stock_history = History()
+
+
+def replay(history: History) -> list:
+    # the stock as of every record
+    values = _load(history.records)
+    stock, states = dict(), list()
+    for minute, pos, n in _records(values):
+        for p in range(pos, pos + 2 * n, 2):
+            item_id = history.slots[values[p]]
+            stock[item_id] = stock.get(item_id, 0) + values[p + 1]
+        states.append({k: v for k, v in stock.items() if v})
+    return states
+
+
+def forward(user: User, stocks: list) -> None:
+    previous = dict()
+    for n, stock in enumerate(stocks):
+        record_stock(user, stock, previous, START + timedelta(minutes=n))
+        previous = stock
+
+
+def test_records_are_little_endian_i32():
+    assert _dump(array('i', [1, -2])) == struct.pack('<ii', 1, -2)
+    assert list(_load(struct.pack('<ii', 7, -3))) == [7, -3]
+
+
+def test_only_changes_are_recorded():
+    user = User()
+    stocks = [{'01': 5, '02': 2}, {'01': 7, '02': 2}, {'01': 7, '02': 2}, {'01': 7, '03': 1}]
+    forward(user, stocks)
+    history = user.stock_history
+    assert history.snapshots == 3
+    assert history.slots == ['01', '02', '03']
+    assert replay(history) == [stocks[0], stocks[1], stocks[3]]
+    # minute, pairs, then (slot, change): the unchanged '02' is not in the second record
+    values = _load(history.records)
+    assert list(values[6:10]) == [values[0] + 1, 1, 0, 2]
+
+
+def test_item_changes():
+    user = User()
+    forward(user, [{'01': 5}, {'01': 5, '02': 1}, {'01': 3}])
+    history = user.stock_history
+    minute = stockhistory._minute(START)
+    assert list(_item_changes(history.slots, history.records, '01')) == [(minute, 5), (minute + 2, -2)]
+    assert list(_item_changes(history.slots, history.records, '02')) == [(minute + 1, 1), (minute + 2, -1)]
+    assert list(_item_changes(history.slots, history.records, '99')) == []
+
+
+def test_merge_first_keeps_the_totals():
+    values = array('i', [10, 2, 0, 5, 1, 2, 11, 2, 0, -5, 2, 4, 12, 1, 2, 1])
+    merged = _merge_first(values)
+    assert list(merged) == [11, 2, 1, 2, 2, 4, 12, 1, 2, 1]
+
+
+def test_history_is_capped(monkeypatch):
+    monkeypatch.setattr(stockhistory.config, 'STOCK_HISTORY_LIMIT', 3)
+    user = User()
+    stocks = [{'01': n, '02': 10 - n} for n in range(1, 7)]
+    forward(user, stocks)
+    history = user.stock_history
+    assert history.snapshots == 3
+    assert replay(history) == stocks[-3:]
+    minutes = [minute for minute, pos, n in _records(_load(history.records))]
+    assert minutes == [stockhistory._minute(START) + n for n in (3, 4, 5)]
+
+
+@pytest.mark.parametrize('when', [START, datetime(1999, 12, 31, 23, 59)])
+def test_minutes_round_trip(when):
+    assert stockhistory._time(stockhistory._minute(when)) == when
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+
+from pony import orm
+
+from models import User, bind
+
+logger = logging.getLogger("cw-crafts-bot")
+
+
+class UserWriteBehind:
+    """Remembers what each user looked like when last written and only queues a write when that changes."""
+
+    def __init__(self, entity):
+        self.entity = entity
+        self.skipped = 0
+        self.flushed = 0
+        self.flushes = 0
+        self._seen = dict()  # user id -> hash of the last written fields
+        self._dirty = dict()  # user id -> fields waiting for the next flush
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def stats(self) -> dict:
+        return {'pending': self.pending, 'skipped': self.skipped, 'written': self.flushed, 'flushes': self.flushes}
+
+    def touch(self, user) -> None:
+        params = self.entity.to_params(user)
+        digest = hash(tuple(params.values()))
+        with self._lock:
+            if self._seen.get(params['id']) == digest:
+                self.skipped += 1
+                return
+            self._seen[params['id']] = digest
+            self._dirty[params['id']] = params
+
+    def flush(self) -> int:
+        with self._lock:
+            dirty, self._dirty = self._dirty, dict()
+        if not dirty:
+            return 0
+        try:
+            bind()
+            with orm.db_session:
+                self.entity.bulk_upsert(list(dirty.values()))
+        except Exception:
+            logger.exception("failed to flush %d users, retrying on the next flush", len(dirty))
+            with self._lock:
+                for user_id, params in dirty.items():
+                    self._dirty.setdefault(user_id, params)
+            return 0
+        self.flushes += 1
+        self.flushed += len(dirty)
+        logger.debug("flushed %d users", len(dirty))
+        return len(dirty)
+
+
+user_store = UserWriteBehind(User)